@@ -0,0 +1,95 @@
+import argparse
+import os
+import sys
+import time
+import tracemalloc
+
+import miditoolkit
+import numpy as np
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+try:
+    from lib.multi_track_b.chord_detect import MIDIChord
+except Exception:
+    raise ValueError('ERROR: cannot import!')
+
+
+def build_notes(n_notes, ticks_per_beat, silence_beats, seed):
+    """ phrases of 16 beats separated by `silence_beats` beats of silence """
+    rng = np.random.default_rng(seed)
+    phrase_beats = 16
+    phrases = rng.integers(0, max(n_notes // 32, 1), n_notes)
+    starts = (phrases * (phrase_beats + silence_beats) * ticks_per_beat
+              + rng.integers(0, phrase_beats * ticks_per_beat, n_notes))
+    ends = starts + rng.integers(1, 2 * ticks_per_beat, n_notes)
+    return starts, ends, rng.integers(21, 109, n_notes), rng.integers(1, 128, n_notes)
+
+
+def note_objects(starts, ends, pitches, velocities):
+    """ `miditoolkit` notes (input of the original path) """
+    return [miditoolkit.midi.containers.Note(velocity=velocity, pitch=pitch, start=start, end=end)
+            for start, end, pitch, velocity in zip(starts.tolist(), ends.tolist(), pitches.tolist(),
+                                                   velocities.tolist())]
+
+
+def pianoroll_chromas(notes, ticks_per_beat):
+    """ chroma of each candidate window as the removed path (`note2pianoroll` of notes, `tochroma` of windows) """
+    max_tick = max([note.end for note in notes])
+    pianoroll = miditoolkit.pianoroll.parser.notes2pianoroll(note_stream_ori=notes, max_tick=max_tick,
+                                                             ticks_per_beat=ticks_per_beat)
+    chromas = []
+    for interval in MIDIChord(ticks_per_beat=ticks_per_beat).beats_to_capture:
+        for start_tick in range(0, max_tick, ticks_per_beat):
+            end_tick = min(int(ticks_per_beat * interval + start_tick), max_tick)
+            chroma = miditoolkit.pianoroll.utils.tochroma(pianoroll=pianoroll[start_tick:end_tick, :])
+            chromas.append(np.sum(chroma, axis=0) > 0)
+    return chromas
+
+
+def measure(function):
+    tracemalloc.start()
+    t = time.perf_counter()
+    function()
+    cost = time.perf_counter() - t
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return cost, peak
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='benchmark peak memory of `MIDIChord.extract_from_arrays`')
+    parser.add_argument('--notes', '-n', type=int, nargs='+', help='numbers of notes to benchmark',
+                        default=(1000, 4000, 16000))
+    parser.add_argument('--silence', '-s', type=int, help='beats of silence between phrases', default=64)
+    parser.add_argument('--ticks_per_beat', '-tpb', type=int, help='ticks per beat', default=960)
+    parser.add_argument('--original', '-og', action='store_true',
+                        help='also measure the removed `note2pianoroll` path (chroma of windows, without scoring)')
+    parser.add_argument('--pianoroll_limit', '-pl', type=float,
+                        help='skip the original path if its pianoroll is larger (GB)', default=2)
+    args = parser.parse_args()
+
+    # build chord lookup table before measuring
+    MIDIChord()
+    for n_notes in args.notes:
+        notes = build_notes(n_notes, args.ticks_per_beat, args.silence, seed=0)
+        n_beats = int(notes[1].max()) // args.ticks_per_beat
+        print(f'notes: {n_notes:>7}, beats: {n_beats:>8}')
+        modes = {'beat tables': lambda: MIDIChord(ticks_per_beat=args.ticks_per_beat).extract_from_arrays(*notes),
+                 'sparse': lambda: MIDIChord(ticks_per_beat=args.ticks_per_beat, sparse=True).extract_from_arrays(
+                     *notes)}
+        if args.original:
+            # `int64` pianoroll of all ticks and pitches
+            pianoroll_size = int(notes[1].max()) * 128 * 8
+            if pianoroll_size > args.pianoroll_limit * 2 ** 30:
+                print(f'    {"note2pianoroll":<16} skipped, pianoroll of {pianoroll_size / 2 ** 30:.2f} GB')
+            else:
+                objects = note_objects(*notes)
+                modes['note2pianoroll'] = lambda: pianoroll_chromas(objects, args.ticks_per_beat)
+        for name, mode in modes.items():
+            try:
+                cost, peak = measure(mode)
+            except MemoryError:
+                tracemalloc.stop()
+                print(f'    {name:<16} memory error')
+                continue
+            print(f'    {name:<16} time: {cost * 1000:9.2f} ms, peak memory: {peak / 2 ** 20:9.2f} MB')
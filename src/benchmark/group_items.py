@@ -0,0 +1,38 @@
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+try:
+    from lib.multi_track_b import MidiEncoder
+    from lib.multi_track_b.common import Item
+except Exception:
+    raise ValueError('ERROR: cannot import!')
+
+
+def build_items(bars, notes_per_bar, ticks_per_bar):
+    items = []
+    for _ in range(bars * notes_per_bar):
+        start = random.randrange(bars * ticks_per_bar)
+        items.append(Item(name='Note', start=start, end=start + 120, velocity=64, pitch=60, program=0))
+    return items
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='benchmark `MidiEncoder.group_items` scaling with file length')
+    parser.add_argument('--bars', '-b', type=int, nargs='+', help='numbers of bars to benchmark',
+                        default=(250, 500, 1000, 2000, 4000))
+    parser.add_argument('--density', '-d', type=int, help='notes per bar', default=16)
+    parser.add_argument('--ticks_per_bar', '-tpb', type=int, help='ticks per bar', default=1920)
+    args = parser.parse_args()
+
+    random.seed(0)
+    for n_bars in args.bars:
+        all_items = build_items(n_bars, args.density, args.ticks_per_bar)
+        t = time.perf_counter()
+        MidiEncoder.group_items(all_items, n_bars * args.ticks_per_bar, args.ticks_per_bar)
+        cost = time.perf_counter() - t
+        print(f'bars: {n_bars:>6}, items: {len(all_items):>7}, '
+              f'time: {cost * 1000:8.2f} ms, per item: {cost / len(all_items) * 1e6:6.3f} us')
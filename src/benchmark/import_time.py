@@ -0,0 +1,44 @@
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+
+src_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# statements run in a fresh process (`{package}` is replaced)
+cases = {'numpy': 'import numpy',
+         'miditoolkit': 'import miditoolkit',
+         'import lib': 'import lib.{package}',
+         'vocabulary': "from lib import get_codec\nget_codec('{package}').w2i",
+         'stream decoder': "from lib import get_codec\nget_codec('{package}').stream_decoder().feed([0, 1, 2])",
+         'decode': "from lib import get_codec\nget_codec('{package}').decoder().decode([0, 1, 2])",
+         'encoder': "from lib import get_codec\nget_codec('{package}').package.MidiEncoder"}
+script = '''import sys
+import time
+t = time.perf_counter()
+{statements}
+print(time.perf_counter() - t, 'numpy' in sys.modules, 'miditoolkit' in sys.modules)
+'''
+
+
+def measure(statements, repeat):
+    """ times (seconds) of statements in fresh processes, and whether `numpy`/`miditoolkit` are loaded """
+    costs = []
+    for _ in range(repeat):
+        output = subprocess.run([sys.executable, '-c', script.format(statements=statements)], cwd=src_dir,
+                                capture_output=True, text=True, check=True).stdout.split()
+        costs.append(float(output[-3]))
+    return costs, output[-2] == 'True', output[-1] == 'True'
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='benchmark import time of packages in fresh processes')
+    parser.add_argument('--package', '-p', type=str, help='package of MIDI Language in `lib`',
+                        default='multi_track_b')
+    parser.add_argument('--repeat', '-r', type=int, help='number of processes for each case', default=5)
+    args = parser.parse_args()
+
+    for name, statements in cases.items():
+        costs, with_numpy, with_miditoolkit = measure(statements.format(package=args.package), args.repeat)
+        print(f'{name:<16} min: {min(costs) * 1000:9.2f} ms, median: {statistics.median(costs) * 1000:9.2f} ms, '
+              f'numpy: {str(with_numpy):<5}, miditoolkit: {with_miditoolkit}')
@@ -0,0 +1,181 @@
+import argparse
+import io
+import json
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import time
+
+import miditoolkit
+import numpy as np
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+try:
+    from lib import codec_names, get_codec
+except Exception:
+    raise ValueError('ERROR: cannot import!')
+
+
+def synthetic_midi(bars, density, instruments, tempo_changes, pedal, seed, ticks_per_beat=480, numerator=4):
+    """
+    reproducible random midi object:
+        * `instruments` tracks (the last one is drum if more than one) of `density` notes per bar each,
+          pitched notes are from a random triad of each bar;
+        * `tempo_changes` random tempo changes after the first tempo;
+        * sustain pedal pressed in a bar with probability `pedal`.
+    """
+    rng = np.random.default_rng(seed)
+    ticks_per_bar = ticks_per_beat * numerator
+    max_tick = bars * ticks_per_bar
+    # a major or minor triad for each bar
+    roots = rng.integers(0, 12, bars)
+    thirds = rng.choice([3, 4], bars)
+    midi_obj = miditoolkit.midi.parser.MidiFile(ticks_per_beat=ticks_per_beat)
+    midi_obj.time_signature_changes = [miditoolkit.midi.containers.TimeSignature(numerator, 4, 0)]
+    for i in range(instruments):
+        is_drum = instruments > 1 and i == instruments - 1
+        instrument = miditoolkit.midi.containers.Instrument(int(rng.integers(128)), is_drum=is_drum)
+        n_notes = bars * density
+        starts = np.sort(rng.integers(0, max_tick, n_notes))
+        ends = starts + rng.integers(ticks_per_beat // 8, 2 * ticks_per_beat, n_notes)
+        if is_drum:
+            pitches = rng.integers(35, 82, n_notes)
+        else:
+            bar_index = starts // ticks_per_bar
+            triad = np.stack([roots, roots + thirds, roots + 7])[rng.integers(0, 3, n_notes), bar_index]
+            pitches = 12 * rng.integers(3, 7) + triad + 12 * rng.integers(0, 2, n_notes)
+        velocities = rng.integers(30, 128, n_notes)
+        instrument.notes = [miditoolkit.Note(velocity, pitch, start, end) for start, end, pitch, velocity in
+                            zip(starts.tolist(), ends.tolist(), pitches.tolist(), velocities.tolist())]
+        midi_obj.instruments.append(instrument)
+    # tempo
+    times = np.sort(rng.integers(1, max_tick, tempo_changes)).tolist()
+    tempos = rng.uniform(40, 240, tempo_changes + 1).tolist()
+    midi_obj.tempo_changes = [miditoolkit.midi.containers.TempoChange(tempo, time)
+                              for tempo, time in zip(tempos, [0] + times)]
+    # sustain pedal (on the first instrument)
+    for bar in np.flatnonzero(rng.random(bars) < pedal).tolist():
+        on = bar * ticks_per_bar + int(rng.integers(ticks_per_beat))
+        off = on + int(rng.integers(ticks_per_beat, ticks_per_bar))
+        midi_obj.instruments[0].control_changes.append(miditoolkit.ControlChange(number=64, value=127, time=on))
+        midi_obj.instruments[0].control_changes.append(miditoolkit.ControlChange(number=64, value=0, time=off))
+    midi_obj.max_tick = max_tick
+    return midi_obj
+
+
+def timed(times, name, function, *args, **kwargs):
+    t = time.perf_counter()
+    result = function(*args, **kwargs)
+    times.setdefault(name, []).append(time.perf_counter() - t)
+    return result
+
+
+def encode_stages(codec, path, times):
+    """ integers of item engine (no variation), each stage timed """
+    me = timed(times, 'parse', codec.encoder, path)
+    me.unknown_tokens = 0
+    me.initialize_variation(False)
+    if codec.name.startswith('multi_track'):
+        note_items, drum_items, tempo_table = timed(times, 'read_items', me.read_items)
+        note_items, drum_items = timed(times, 'quantize', lambda: (
+            me.quantize_items(note_items, ticks=me.quantized_ticks),
+            me.quantize_items(drum_items, ticks=me.quantized_ticks)))
+        chord_items = timed(times, 'chords', me.extract_chords, note_items)
+        max_time = note_items[-1].end
+        groups = timed(times, 'group', lambda: me.group_items(
+            (note_items if me.with_note else []) + (drum_items if me.with_drum else []) +
+            (me.tempo_items(tempo_table, max_time, ticks_per_bar=me.ticks_per_bar) if me.with_tempo else []) +
+            (chord_items if me.with_chord else []), max_time, ticks_per_bar=me.ticks_per_bar))
+    else:
+        note_items, control_items = timed(times, 'read_items', me.read_items)
+        note_items, control_items = timed(times, 'quantize', lambda: (
+            me.quantize_items(note_items),
+            me.quantize_items(control_items, quantize_duration=False) if codec.name == 'piano_track_b'
+            else me.quantize_items(control_items)))
+        groups = timed(times, 'group', lambda: sorted(
+            (note_items if me.with_note else []) + (control_items if me.with_control else []),
+            key=lambda x: x.start if codec.name == 'piano_track_b' else x.time))
+    events = timed(times, 'events', me.item_to_event, groups)
+    words = timed(times, 'words', me.events_to_words, events)
+    ints = np.array(timed(times, 'integers', me.words_to_integers, words))
+    timed(times, 'encode_fast', me.encode_fast, False)
+    return ints
+
+
+def decode_stages(codec, ints, times):
+    """ each stage of decoding integers timed """
+    md = codec.decoder()
+    codes, values = timed(times, 'tokens', md.integers_to_tokens, ints)
+    if codec.name.startswith('multi_track'):
+        temp_notes, temp_drums, temp_chords, temp_tempos = timed(times, 'extract_events', md.extract_events,
+                                                                 codes, values)
+        timed(times, 'build_notes', md.build_notes_drums, temp_notes)
+        timed(times, 'build_drums', md.build_notes_drums, temp_drums)
+        timed(times, 'build_chords', md.build_chords, temp_chords)
+        timed(times, 'build_tempos', md.build_tempos, temp_tempos)
+    else:
+        temp_notes, temp_controls = timed(times, 'extract_events', md.extract_events, codes, values)
+        timed(times, 'build_notes', md.build_notes, temp_notes)
+        timed(times, 'build_controls', md.build_controls, temp_controls)
+    midi = timed(times, 'build_midi', codec.decoder().build_midi, ints)
+    timed(times, 'dump', midi.dump, file=io.BytesIO())
+    timed(times, 'stream', codec.stream_decoder().feed, ints)
+
+
+def summary(times):
+    return {name: {'min': min(costs), 'median': statistics.median(costs), 'runs': costs}
+            for name, costs in times.items()}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='benchmark each stage of encoders and decoders on synthetic midi')
+    parser.add_argument('--packages', '-p', type=str, nargs='+', help='packages of MIDI Language in `lib`',
+                        default=codec_names)
+    parser.add_argument('--bars', '-b', type=int, help='length of synthetic midi in bars', default=200)
+    parser.add_argument('--density', '-d', type=int, help='notes per bar of each instrument', default=16)
+    parser.add_argument('--instruments', '-n', type=int, help='number of instruments (last one is drum)',
+                        default=4)
+    parser.add_argument('--tempo_changes', '-t', type=int, help='number of tempo changes', default=20)
+    parser.add_argument('--pedal', '-pd', type=float, help='probability of sustain pedal in a bar', default=0.5)
+    parser.add_argument('--seed', '-s', type=int, help='random seed of synthetic midi', default=0)
+    parser.add_argument('--repeat', '-r', type=int, help='timed runs of each stage', default=5)
+    parser.add_argument('--output', '-o', type=str, help='output `.json` file of results',
+                        default='benchmark_stages.json')
+    args = parser.parse_args()
+
+    config = {key: value for key, value in vars(args).items() if key != 'output'}
+    midi_obj = synthetic_midi(args.bars, args.density, args.instruments, args.tempo_changes, args.pedal, args.seed)
+    results = {'config': config,
+               'environment': {'python': platform.python_version(), 'numpy': np.__version__,
+                               'miditoolkit': miditoolkit.__version__, 'machine': platform.machine()},
+               'midi': {'notes': sum(len(instrument.notes) for instrument in midi_obj.instruments),
+                        'controls': sum(len(instrument.control_changes) for instrument in midi_obj.instruments),
+                        'tempo_changes': len(midi_obj.tempo_changes), 'max_tick': midi_obj.max_tick},
+               'packages': {}}
+    with tempfile.TemporaryDirectory() as temp_dir:
+        midi_path = os.path.join(temp_dir, 'synthetic.mid')
+        midi_obj.dump(midi_path)
+        for package in args.packages:
+            codec = get_codec(package)
+            # warm up (chord table, lazy imports), not timed
+            ints = encode_stages(codec, midi_path, {})
+            if not np.array_equal(ints, codec.encoder(midi_path).encode_items(False)):
+                raise ValueError(f'ERROR: [{package}] stages differ from `encode_items()`!')
+            decode_stages(codec, ints, {})
+            encode_times = {}
+            decode_times = {}
+            for _ in range(args.repeat):
+                encode_stages(codec, midi_path, encode_times)
+                decode_stages(codec, ints, decode_times)
+            results['packages'][package] = {'tokens': len(ints), 'encode': summary(encode_times),
+                                            'decode': summary(decode_times)}
+            print(f'{package} ({len(ints)} tokens)')
+            for direction in ['encode', 'decode']:
+                for name, result in results['packages'][package][direction].items():
+                    print(f'    {direction} {name:<16} min: {result["min"] * 1000:9.2f} ms, '
+                          f'median: {result["median"] * 1000:9.2f} ms')
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f'Results: {args.output}')
@@ -0,0 +1,170 @@
+import argparse
+import os
+import random
+import sys
+
+import numpy as np
+
+from lib import codec_names, get_codec
+
+# variation ranges of `MidiEncoder` (negative scales draw random velocity shifts)
+variation_configs = [{},
+                     {'pitch_variation_range': (-6, 6), 'tempo_scale_variation_range': (0.8, 1.2)},
+                     {'velocity_scale_variation_range': (0.6, 1.4)},
+                     {'velocity_scale_variation_range': (-0.5, -0.4)},
+                     {'velocity_scale_variation_range': (-1, 1), 'pitch_variation_range': (-6, 6)},
+                     {'velocity_scale_variation_range': (-0.5, -0.4),
+                      'velocity_noise_scale_variation_range': (0.9, 1.1)},
+                     {'velocity_scale_variation_range': (0.8, 1.2),
+                      'velocity_noise_scale_variation_range': (-0.2, -0.1)}]
+
+
+def check_engines(codec, path, rounds):
+    """ `encode_fast()` gives the same integers as `encode_items()` for each variation config """
+    failures = []
+    for config in variation_configs:
+        encoder = codec.encoder(path, **config)
+        if not encoder.cross_check(False) or not all(encoder.cross_check(True) for _ in range(rounds)):
+            failures.append(f'cross_check {config}')
+    return failures
+
+
+def check_variations(codec, path, rounds, seed=0):
+    """ `encode_variations(k, seed)` gives the same integers as `k` calls of `encode()` (both engines) from `seed` """
+    failures = []
+    for config in variation_configs:
+        encoder = codec.encoder(path, **config)
+        variations = encoder.encode_variations(rounds, seed=seed)
+        for fast in [False, True]:
+            encoder.fast = fast
+            encoder.rng = random.Random(seed)
+            if not all(np.array_equal(encoder.encode(), ints) for ints in variations):
+                failures.append(f'encode_variations (fast: {fast}) {config}')
+    return failures
+
+
+def check_iter_encode(codec, path, seed=0):
+    """ integers of `iter_encode()` concatenate to `encode()` (both engines) from `seed` """
+    failures = []
+    for config in variation_configs:
+        encoder = codec.encoder(path, **config)
+        if not hasattr(encoder, 'iter_encode'):
+            return failures
+        for fast in [False, True]:
+            encoder.fast = fast
+            encoder.rng = random.Random(seed)
+            ints = encoder.encode()
+            encoder.rng = random.Random(seed)
+            if not np.array_equal(np.concatenate(list(encoder.iter_encode())), ints):
+                failures.append(f'iter_encode (fast: {fast}) {config}')
+    return failures
+
+
+def check_token_space(codec):
+    """ ids of `w2i` words are given back by `TokenSpace.ids()`, and classified to their family and value """
+    token_space = codec.event_dict.token_space
+    families = list(token_space.families.values())
+    ids = list(range(token_space.size)) + [-1, token_space.size, token_space.size + 100]
+    codes, values = token_space.classify(ids)
+    failures = []
+    if token_space.classification() != (token_space.id_codes.tolist(), token_space.id_values.tolist()):
+        failures.append('token space classification')
+    if codes[token_space.size:].tolist() != [-1] * 3:
+        failures.append('token space unknown ids')
+    for word, index in codec.w2i.items():
+        name, _, value = word.partition(token_space.separator)
+        family = token_space.families.get(name)
+        if family is None or codes[index] < 0 or families[codes[index]] is not family:
+            failures.append(f'token space family of `{word}`')
+            continue
+        if family.labels is not None:
+            decoded = family.labels[values[index]]
+        elif family.start is not None:
+            decoded = str(values[index])
+        else:
+            decoded = ''
+        if decoded != value or token_space.ids(name, [value if family.start is None else int(value)])[0] != index:
+            failures.append(f'token space value of `{word}`')
+    return failures
+
+
+def midi_elements(midi):
+    """ notes of each (program, is drum), controls, tempos and chords (markers) of midi object """
+    notes = {}
+    for instrument in midi.instruments:
+        notes.setdefault((instrument.program, instrument.is_drum), []).extend(
+            (note.start, note.end, note.pitch, note.velocity) for note in instrument.notes)
+    controls = [(control.number, control.value, control.time)
+                for instrument in midi.instruments for control in instrument.control_changes]
+    return ({key: value for key, value in notes.items() if len(value) > 0}, controls,
+            [(tempo.time, tempo.tempo) for tempo in midi.tempo_changes],
+            [(marker.time, marker.text) for marker in midi.markers])
+
+
+def stream_elements(items):
+    """ `midi_elements()` of items from `MidiStreamDecoder` """
+    notes, controls, tempos, chords = {}, [], [], []
+    for i, item in enumerate(items):
+        if item.name in ['Note', 'Drum']:
+            notes.setdefault((getattr(item, 'program', 0), item.name == 'Drum'), []).append(
+                (item.start, item.end, item.pitch, item.velocity))
+        elif item.name == 'NoteOff':
+            # note-on item is just before
+            notes.setdefault((0, False), []).append((items[i - 1].time, item.time, item.pitch, item.velocity))
+        elif item.name in ['PaddleOn', 'PaddleOff']:
+            controls.append((item.pitch, 127 if item.name == 'PaddleOn' else 0,
+                             item.time if hasattr(item, 'time') else item.start))
+        elif item.name == 'Tempo':
+            tempos.append((item.start, item.pitch))
+        elif item.name == 'Chord':
+            chords.append((item.start, item.pitch))
+    return notes, controls, tempos, chords
+
+
+def check_stream_decoder(codec, path, seed=0):
+    """ `MidiStreamDecoder` fed by random chunks gives the same midi elements as `MidiDecoder.decode()`, for integers
+    of `encode()` and their prefixes """
+    rng = random.Random(seed)
+    integers = codec.encoder(path).encode(variation=False).tolist()
+    failures = []
+    for length in [len(integers)] + [rng.randrange(len(integers)) for _ in range(3)]:
+        # bad cases are counted instead of printed
+        midi = codec.decoder(stats=codec.package.Stats()).decode(integers[:length])
+        stream_decoder = codec.stream_decoder(stats=codec.package.Stats())
+        items = []
+        i = 0
+        while i < length:
+            chunk_size = rng.choice([1, 1, 2, 5, 17])
+            items.extend(stream_decoder.feed(integers[i:min(i + chunk_size, length)]))
+            i += chunk_size
+        if midi_elements(midi) != stream_elements(items):
+            failures.append(f'stream decoder ({length} integers)')
+    return failures
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='check encoders and decoders of packages against each other')
+    parser.add_argument('--packages', '-p', type=str, nargs='+', help='packages of MIDI Language in `lib`',
+                        default=codec_names)
+    parser.add_argument('--input', '-i', type=str, nargs='+', help='midi files to check',
+                        default=[os.path.join(os.path.dirname(os.path.abspath(__file__)), 'demo', name)
+                                 for name in ['multi_track.mid', 'piano_track.mid', 'tempo_changes.mid']])
+    parser.add_argument('--rounds', '-r', type=int, help='random variations of each config', default=3)
+    args = parser.parse_args()
+
+    n_failures = 0
+    for package in args.packages:
+        codec = get_codec(package)
+        for failure in check_token_space(codec):
+            print(f'FAIL: [{package}] {failure}')
+            n_failures += 1
+        for midi_path in args.input:
+            failures = (check_engines(codec, midi_path, args.rounds) + check_variations(codec, midi_path, args.rounds) +
+                        check_iter_encode(codec, midi_path) + check_stream_decoder(codec, midi_path))
+            for failure in failures:
+                print(f'FAIL: [{package}] {os.path.basename(midi_path)}: {failure}')
+            n_failures += len(failures)
+        print(f'{package} checked')
+    if n_failures > 0:
+        sys.exit(f'ERROR: {n_failures} checks failed!')
+    print('All checks passed')
@@ -0,0 +1,153 @@
+import argparse
+import hashlib
+import multiprocessing
+import os
+import random
+import tarfile
+import tempfile
+import zipfile
+
+import numpy as np
+
+from lib import get_codec
+from lib.indexed_dataset import IndexedDataset, IndexedDatasetWriter
+
+# state of each worker process (see `initialize_worker()`)
+worker = {}
+
+
+def midi_files(path, formats=('mid', 'midi')):
+    """ (name, path, data) of midi files in a folder (recursively), a text file of paths, an archive, or a midi file """
+    if os.path.isdir(path):
+        paths = []
+        for root, _, files in os.walk(path):
+            paths.extend(os.path.join(root, f) for f in files if f.split('.')[-1].lower() in formats)
+        for p in sorted(paths):
+            yield os.path.relpath(p, path), p, None
+    elif path.endswith('.txt'):
+        with open(path) as f:
+            for line in f:
+                if line.strip():
+                    yield line.strip(), line.strip(), None
+    elif zipfile.is_zipfile(path):
+        with zipfile.ZipFile(path) as archive:
+            for name in sorted(archive.namelist()):
+                if name.split('.')[-1].lower() in formats:
+                    yield os.path.normpath(name), None, archive.read(name)
+    elif tarfile.is_tarfile(path):
+        with tarfile.open(path) as archive:
+            for member in sorted(archive.getmembers(), key=lambda x: os.path.normpath(x.name)):
+                if member.isfile() and member.name.split('.')[-1].lower() in formats:
+                    yield os.path.normpath(member.name), None, archive.extractfile(member).read()
+    else:
+        yield os.path.basename(path), path, None
+
+
+def file_seed(name, epoch, seed=0):
+    """ random seed of variations derived from file name and epoch """
+    return int.from_bytes(hashlib.sha1(f'{seed}/{epoch}/{name}'.encode()).digest()[:8], 'little')
+
+
+def initialize_worker(ops):
+    # one dictionary for each worker
+    worker['codec'] = get_codec(ops.package)
+    worker['midi_cache'] = worker['codec'].package.MidiCache(ops.cache) if ops.cache is not None else None
+    worker['ops'] = ops
+
+
+def encode_file(midi_file):
+    """ token sequences of a midi file (`None` and the error if cannot encode) """
+    name, path, data = midi_file
+    codec, ops = worker['codec'], worker['ops']
+    # noinspection PyBroadException
+    try:
+        if data is not None:
+            # file from archive
+            with tempfile.NamedTemporaryFile(suffix='.mid', delete=False) as f:
+                f.write(data)
+            path = f.name
+        try:
+            if ops.variations > 0:
+                me = codec.encoder(path,
+                                   pitch_variation_range=(-6, 6),
+                                   velocity_scale_variation_range=(0.9, 1),
+                                   velocity_noise_scale_variation_range=(0.95, 1.05),
+                                   tempo_scale_variation_range=(0.7, 1.4),
+                                   fast=ops.fast,
+                                   midi_cache=worker['midi_cache'])
+                seed = file_seed(name, ops.epoch, ops.seed)
+                if ops.fast:
+                    return name, me.encode_variations(ops.variations, seed=seed), None
+                # item engine, same integers as `encode_variations()`
+                me.rng = random.Random(seed)
+                return name, [me.encode() for _ in range(ops.variations)], None
+            else:
+                me = codec.encoder(path, fast=ops.fast, midi_cache=worker['midi_cache'])
+                return name, [me.encode(variation=False)], None
+        finally:
+            if data is not None:
+                os.remove(path)
+    except Exception as e:
+        # broken midi files raise all kinds of errors, report them and go on
+        return name, None, f'{type(e).__name__}: {e}'
+
+
+def shard_prefix(prefix, shard, n_shards):
+    if n_shards == 1:
+        return prefix
+    return f'{prefix}_{shard:05d}_of_{n_shards:05d}'
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='tokenize midi corpus into indexed dataset with MIDI Language')
+    parser.add_argument('--input', '-i', type=str,
+                        help='the input folder/file, a text file for paths, or an archive (`.zip`/`.tar`)',
+                        default='demo')
+    parser.add_argument('--output', '-o', type=str, help='output prefix of `.bin`/`.idx` files',
+                        default='demo/corpus')
+    parser.add_argument('--package', '-p', type=str, help='package of MIDI Language in `lib`',
+                        default='multi_track_b')
+    parser.add_argument('--variations', '-k', type=int,
+                        help='number of variations (data augmentation) of each file, no variation if `0`', default=0)
+    parser.add_argument('--epoch', '-e', type=int, help='epoch of variations (seeds derive from file and epoch)',
+                        default=0)
+    parser.add_argument('--seed', '-s', type=int, help='base random seed of variations', default=0)
+    parser.add_argument('--fast', '-f', action='store_true', help='encode with struct-of-arrays engine')
+    parser.add_argument('--cache', '-cd', type=str, help='folder of parsed midi cache (no cache if not given)',
+                        default=None)
+    parser.add_argument('--shards', '-n', type=int, help='number of output shards (files go round-robin)',
+                        default=1)
+    parser.add_argument('--cpu_number', '-j', type=int, help='cpu number of processing (all if `0`)', default=0)
+    parser.add_argument('--chunk_size', '-cs', type=int, help='files sent to a worker at once', default=4)
+    args = parser.parse_args()
+
+    # vocabulary (workers build their own)
+    w2i = get_codec(args.package).w2i
+    print(f'Dict length: {len(w2i)}')
+    dtype = np.uint16 if len(w2i) <= np.iinfo(np.uint16).max + 1 else np.int32
+    cpu_number = args.cpu_number if args.cpu_number > 0 else os.cpu_count()
+
+    # encode midi files into indexed dataset shards (same output for any `cpu_number`)
+    writers = [IndexedDatasetWriter(shard_prefix(args.output, i, args.shards), dtype=dtype)
+               for i in range(args.shards)]
+    if cpu_number == 1:
+        initialize_worker(args)
+        results = map(encode_file, midi_files(args.input))
+    else:
+        pool = multiprocessing.Pool(cpu_number, initializer=initialize_worker, initargs=(args,))
+        results = pool.imap(encode_file, midi_files(args.input), chunksize=args.chunk_size)
+    n_files = 0
+    for file_name, sequences, error in results:
+        if sequences is None:
+            print(f'ERROR: [{file_name}] cannot encode! ({error})')
+            continue
+        for sequence in sequences:
+            writers[n_files % args.shards].add(sequence)
+        n_files += 1
+    for writer in writers:
+        writer.close()
+    if cpu_number > 1:
+        pool.close()
+        pool.join()
+    sizes = [IndexedDataset(shard_prefix(args.output, i, args.shards)).sizes for i in range(args.shards)]
+    print(f'Files: {n_files}, sequences: {sum(len(s) for s in sizes)}, tokens: {int(sum(np.sum(s) for s in sizes))}')
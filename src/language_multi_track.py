@@ -10,11 +10,16 @@ if __name__ == '__main__':
     parser.add_argument('--output', '-o', type=str, help='output file of audio file to encode',
                         default='demo/out.mid')
     parser.add_argument('--train', '-t', action='store_true', help='training mode with variations (data augmentation)')
+    parser.add_argument('--fast', '-f', action='store_true', help='encode with struct-of-arrays engine')
+    parser.add_argument('--check', '-c', action='store_true', help='check struct-of-arrays engine with item engine')
+    parser.add_argument('--cache', '-cd', type=str, help='folder of parsed midi cache (no cache if not given)',
+                        default=None)
     args = parser.parse_args()
 
     # initialize dict once
     w2i, i2w = EventDict().check_and_load_dict()
     print(f'Dict length: {len(w2i)}')
+    midi_cache = MidiCache(args.cache) if args.cache is not None else None
 
     # encode midi to integer array
     if args.train:
@@ -22,9 +27,13 @@ if __name__ == '__main__':
                          pitch_variation_range=(-6, 6),
                          velocity_scale_variation_range=(0.9, 1),
                          velocity_noise_scale_variation_range=(0.95, 1.05),
-                         tempo_scale_variation_range=(0.7, 1.4))
+                         tempo_scale_variation_range=(0.7, 1.4),
+                         fast=args.fast,
+                         midi_cache=midi_cache)
     else:
-        me = MidiEncoder(args.input, w2i)
+        me = MidiEncoder(args.input, w2i, fast=args.fast, midi_cache=midi_cache)
+    if args.check:
+        print(f'Check struct-of-arrays engine: {me.cross_check()}')
     res = me.encode()
 
     # decode integer array to midi
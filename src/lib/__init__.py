@@ -0,0 +1,37 @@
+import importlib
+
+# packages of MIDI Language
+codec_names = ('multi_track_a', 'multi_track_b', 'piano_track_a', 'piano_track_b')
+# codecs loaded in this process
+codecs = {}
+
+
+class Codec(object):
+    """ package of MIDI Language with its vocabulary (loaded once for each process) """
+
+    def __init__(self, name):
+        self.name = name
+        self.package = importlib.import_module(f'{__name__}.{name}')
+        self.event_dict = self.package.EventDict()
+        self.w2i, self.i2w = self.event_dict.check_and_load_dict()
+
+    def encoder(self, file_path, **kwargs):
+        """ `MidiEncoder` of midi file with vocabulary """
+        return self.package.MidiEncoder(file_path, self.w2i, **kwargs)
+
+    def decoder(self, **kwargs):
+        """ `MidiDecoder` with vocabulary """
+        return self.package.MidiDecoder(self.i2w, **kwargs)
+
+    def stream_decoder(self, **kwargs):
+        """ `MidiStreamDecoder` of a new `MidiDecoder` """
+        return self.package.MidiStreamDecoder(self.decoder(**kwargs))
+
+
+def get_codec(name):
+    """ codec of package name (all packages can be loaded in one process) """
+    if name not in codec_names:
+        raise ValueError(f'ERROR: codec `{name}` not found!')
+    if name not in codecs:
+        codecs[name] = Codec(name)
+    return codecs[name]
@@ -0,0 +1,104 @@
+import os
+import struct
+
+import numpy as np
+
+
+class IndexedDatasetLayout(object):
+    """
+    memory-mapped indexed dataset layout (`MMIDIDX` of fairseq `MMapIndexedDataset`):
+        * `<prefix>.bin`: tokens of all sequences, one after another;
+        * `<prefix>.idx`: magic, version (`<Q`), dtype code (`<B`), number of sequences (`<Q`),
+          then sizes (`int32`) and byte offsets (`int64`) of sequences.
+    """
+    magic = b'MMIDIDX\x00\x00'
+    version = 1
+    dtypes = {1: np.uint8, 2: np.int8, 3: np.int16, 4: np.int32, 5: np.int64, 6: np.float64, 7: np.double,
+              8: np.uint16}
+
+    @classmethod
+    def dtype_code(cls, dtype):
+        for code, code_dtype in cls.dtypes.items():
+            if np.dtype(code_dtype) == np.dtype(dtype):
+                return code
+        raise ValueError(f'ERROR: dtype `{np.dtype(dtype)}` not supported!')
+
+    @staticmethod
+    def bin_path(prefix):
+        return prefix + '.bin'
+
+    @staticmethod
+    def idx_path(prefix):
+        return prefix + '.idx'
+
+
+class IndexedDatasetWriter(IndexedDatasetLayout):
+    """ append token sequences to `<prefix>.bin`, write `<prefix>.idx` when closed """
+
+    def __init__(self, prefix, dtype=np.uint16):
+        self.prefix = prefix
+        self.dtype = np.dtype(dtype)
+        self.dtype_code(self.dtype)
+        self.sizes = []
+        self.bin_file = open(self.bin_path(prefix), 'wb')
+
+    def add(self, tokens):
+        tokens = np.asarray(tokens)
+        if len(tokens) > 0 and (tokens.min() < np.iinfo(self.dtype).min or tokens.max() > np.iinfo(self.dtype).max):
+            raise ValueError(f'ERROR: tokens out of `{self.dtype}` range!')
+        self.bin_file.write(tokens.astype(self.dtype).tobytes(order='C'))
+        self.sizes.append(len(tokens))
+
+    def close(self):
+        self.bin_file.close()
+        sizes = np.array(self.sizes, dtype=np.int32)
+        pointers = np.zeros(len(sizes), dtype=np.int64)
+        np.cumsum(sizes[:-1].astype(np.int64) * self.dtype.itemsize, out=pointers[1:])
+        with open(self.idx_path(self.prefix), 'wb') as f:
+            f.write(self.magic)
+            f.write(struct.pack('<Q', self.version))
+            f.write(struct.pack('<B', self.dtype_code(self.dtype)))
+            f.write(struct.pack('<Q', len(sizes)))
+            f.write(sizes.tobytes(order='C'))
+            f.write(pointers.tobytes(order='C'))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+class IndexedDataset(IndexedDatasetLayout):
+    """ read token sequences of `<prefix>.bin`/`<prefix>.idx` by memory map (nothing loaded) """
+
+    def __init__(self, prefix):
+        with open(self.idx_path(prefix), 'rb') as f:
+            if f.read(len(self.magic)) != self.magic:
+                raise ValueError(f'ERROR: [{self.idx_path(prefix)}] is not indexed dataset!')
+            version, = struct.unpack('<Q', f.read(8))
+            if version != self.version:
+                raise ValueError(f'ERROR: [{self.idx_path(prefix)}] version {version} not supported!')
+            code, = struct.unpack('<B', f.read(1))
+            self.dtype = np.dtype(self.dtypes[code])
+            length, = struct.unpack('<Q', f.read(8))
+            offset = f.tell()
+        # (empty files cannot be memory-mapped)
+        if length > 0:
+            index = np.memmap(self.idx_path(prefix), mode='r', offset=offset)
+            self.sizes = np.frombuffer(index, dtype=np.int32, count=length)
+            self.pointers = np.frombuffer(index, dtype=np.int64, count=length, offset=self.sizes.nbytes)
+        else:
+            self.sizes = np.zeros(0, dtype=np.int32)
+            self.pointers = np.zeros(0, dtype=np.int64)
+        if os.path.getsize(self.bin_path(prefix)) > 0:
+            self.tokens = np.memmap(self.bin_path(prefix), mode='r', dtype=self.dtype)
+        else:
+            self.tokens = np.zeros(0, dtype=self.dtype)
+
+    def __len__(self):
+        return len(self.sizes)
+
+    def __getitem__(self, i):
+        start = self.pointers[i] // self.dtype.itemsize
+        return self.tokens[start:start + self.sizes[i]]
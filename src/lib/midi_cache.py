@@ -0,0 +1,159 @@
+import hashlib
+import os
+import shutil
+import uuid
+
+import miditoolkit
+import numpy as np
+from miditoolkit.midi.containers import ControlChange, Instrument, Note, TempoChange, TimeSignature
+
+
+class MidiCache(object):
+    """
+    on-disk cache of parsed midi files, keyed by file content hash and parser version:
+        * one folder of `.npy` arrays (memory-mapped when loading) for each midi file;
+        * least recently used folders are removed when cache is larger than `max_size` bytes.
+    """
+    # change it when cached arrays change
+    parser_version = f'1-miditoolkit-{miditoolkit.__version__}'
+    # eviction goes below `max_size` by this ratio, so the cache folder is not scanned for every new entry
+    evict_ratio = 0.9
+    # arrays of an entry (`midi_to_arrays()`)
+    array_names = ('meta', 'instruments', 'notes', 'controls', 'tempos', 'time_signatures')
+
+    def __init__(self, cache_dir, max_size=2 ** 30):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        # bytes of cache folder (scanned at first store, then counted by stores of this process)
+        self.total_size = None
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def key(self, path):
+        """ hash of file content and parser version """
+        sha = hashlib.sha1(self.parser_version.encode())
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                sha.update(block)
+        return sha.hexdigest()
+
+    @staticmethod
+    def midi_to_arrays(midi_obj):
+        """ compact arrays of parsed midi (notes and control changes in instrument order) """
+        instruments = midi_obj.instruments
+        return {'meta': np.array([midi_obj.ticks_per_beat, midi_obj.max_tick], dtype=np.int64),
+                # program, is drum, number of notes, number of control changes
+                'instruments': np.array([[instrument.program, instrument.is_drum, len(instrument.notes),
+                                          len(instrument.control_changes)] for instrument in instruments],
+                                        dtype=np.int64).reshape(-1, 4),
+                'notes': np.array([[note.start, note.end, note.pitch, note.velocity]
+                                   for instrument in instruments for note in instrument.notes],
+                                  dtype=np.int64).reshape(-1, 4),
+                'controls': np.array([[control.number, control.value, control.time]
+                                      for instrument in instruments for control in instrument.control_changes],
+                                     dtype=np.int64).reshape(-1, 3),
+                'tempos': np.array([[tempo.tempo, tempo.time] for tempo in midi_obj.tempo_changes],
+                                   dtype=np.float64).reshape(-1, 2),
+                'time_signatures': np.array([[time_sig.numerator, time_sig.denominator, time_sig.time]
+                                             for time_sig in midi_obj.time_signature_changes],
+                                            dtype=np.int64).reshape(-1, 3)}
+
+    @staticmethod
+    def arrays_to_midi(arrays, with_instruments=True):
+        """ `miditoolkit` midi object from arrays of `midi_to_arrays()` (only tempos and time signatures if not
+        `with_instruments`) """
+        midi_obj = miditoolkit.midi.parser.MidiFile(ticks_per_beat=int(arrays['meta'][0]))
+        midi_obj.max_tick = int(arrays['meta'][1])
+        if with_instruments:
+            notes = arrays['notes'].tolist()
+            controls = arrays['controls'].tolist()
+            n_notes = 0
+            n_controls = 0
+            for program, is_drum, note_count, control_count in arrays['instruments'].tolist():
+                instrument = Instrument(program=program, is_drum=bool(is_drum))
+                instrument.notes = [Note(velocity=velocity, pitch=pitch, start=start, end=end)
+                                    for start, end, pitch, velocity in notes[n_notes:n_notes + note_count]]
+                instrument.control_changes = [ControlChange(number=number, value=value, time=time)
+                                              for number, value, time in
+                                              controls[n_controls:n_controls + control_count]]
+                midi_obj.instruments.append(instrument)
+                n_notes += note_count
+                n_controls += control_count
+        # tempo of `miditoolkit` is float, time is integer
+        midi_obj.tempo_changes = [TempoChange(tempo=tempo, time=int(time))
+                                  for tempo, time in arrays['tempos'].tolist()]
+        midi_obj.time_signature_changes = [TimeSignature(numerator=numerator, denominator=denominator, time=time)
+                                           for numerator, denominator, time in arrays['time_signatures'].tolist()]
+        return midi_obj
+
+    def load_arrays(self, path):
+        """ arrays of midi file (memory-mapped if cached), parse and store them if not cached """
+        entry_dir = os.path.join(self.cache_dir, self.key(path))
+        try:
+            # recently used
+            os.utime(entry_dir)
+            arrays = {os.path.splitext(name)[0]: np.load(os.path.join(entry_dir, name), mmap_mode='r')
+                      for name in os.listdir(entry_dir)}
+            if all(name in arrays for name in self.array_names):
+                return arrays
+            # incomplete entry (such as written by other version), parse again
+            shutil.rmtree(entry_dir, ignore_errors=True)
+        except OSError:
+            # not cached, or removed by other process meanwhile
+            pass
+        arrays = self.midi_to_arrays(miditoolkit.midi.parser.MidiFile(path))
+        self.store(entry_dir, arrays)
+        # scan cache folder only if it may be larger than `max_size`
+        if self.total_size > self.max_size:
+            self.evict(keep=entry_dir)
+        return arrays
+
+    def load_midi(self, path):
+        """ `miditoolkit` midi object of midi file through cache """
+        return self.arrays_to_midi(self.load_arrays(path))
+
+    def store(self, entry_dir, arrays):
+        # write to temporary folder, then rename (other processes never see partial entries)
+        temp_dir = f'{entry_dir}.{uuid.uuid4().hex}.tmp'
+        os.makedirs(temp_dir)
+        for name, array in arrays.items():
+            np.save(os.path.join(temp_dir, name + '.npy'), array)
+        size = sum(entry.stat().st_size for entry in os.scandir(temp_dir))
+        try:
+            os.rename(temp_dir, entry_dir)
+        except OSError:
+            # stored by other process
+            shutil.rmtree(temp_dir, ignore_errors=True)
+            size = 0
+        if self.total_size is None:
+            self.total_size = sum(size for _, size, _ in self.entries())
+        else:
+            self.total_size += size
+
+    def entries(self):
+        """ (last used time, bytes, folder) of cached entries """
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            entry_dir = os.path.join(self.cache_dir, name)
+            if name.endswith('.tmp') or not os.path.isdir(entry_dir):
+                continue
+            # noinspection PyBroadException
+            try:
+                size = sum(entry.stat().st_size for entry in os.scandir(entry_dir))
+                entries.append((os.path.getmtime(entry_dir), size, entry_dir))
+            except Exception:
+                # removed by other process
+                continue
+        return entries
+
+    def evict(self, keep=None):
+        """ remove least recently used entries (except `keep`) down to `evict_ratio` of `max_size` """
+        entries = self.entries()
+        total_size = sum(size for _, size, _ in entries)
+        for _, size, entry_dir in sorted(entries):
+            if total_size <= self.max_size * self.evict_ratio:
+                break
+            if entry_dir == keep:
+                continue
+            shutil.rmtree(entry_dir, ignore_errors=True)
+            total_size -= size
+        self.total_size = total_size
@@ -1,21 +1,39 @@
+import copy
+import io
+import multiprocessing
+import numbers
 import os
-import sys
 
-import miditoolkit
-import numpy as np
+from .common import Common, Item, LazyModule, TokenSpace
 
-sys.path.append(os.path.dirname(os.path.abspath(__file__)))
-try:
-    from common import Common, Event
-except Exception:
-    raise ValueError('ERROR: cannot import!')
+# loaded at first use
+miditoolkit = LazyModule('miditoolkit')
+np = LazyModule('numpy')
+
+# decoder of each worker process (see `initialize_worker()`)
+worker = {}
+
+
+def initialize_worker(decoder):
+    # one decoder (and `i2w`) for each worker
+    worker['decoder'] = decoder
+
+
+def decode_sequence(task):
+    integers, output_path, output_format = task
+    return worker['decoder'].decode(integers, output_path=output_path, output_format=output_format)
 
 
 class MidiDecoder(Common):
+    output_formats = ('midi', 'bytes', 'arrays')
+
     def __init__(self, i2w, numerator=4, denominator=4, ticks_per_beat=480,
-                 decode_note=True, decode_drum=True, decode_tempo=True, decode_chord=True):
+                 decode_note=True, decode_drum=True, decode_tempo=True, decode_chord=True, stats=None):
         super().__init__()
         self.i2w = i2w
+        self.token_space = TokenSpace.from_i2w(i2w, self.separator)
+        # stage timers and token counters (`Stats`) if instrumented
+        self.stats = stats
         # numerator/denominator will be given outside
         self.numerator = numerator
         self.denominator = denominator
@@ -30,178 +48,153 @@ class MidiDecoder(Common):
         self.default_quantized_ticks = int(self.default_ticks_per_beat / self.quantized_beat_splits)
         self.ticks_per_bar = self.default_ticks_per_beat * numerator
 
-    def extract_events(self, events):
-        # get downbeat and note (no time)
+    def extract_events(self, codes, values):
+        # family codes of tokens
+        bar = self.token_space.code('Bar')
+        note_pattern = [self.token_space.code(x)
+                        for x in ['Position', 'Note', 'Program', 'Pitch', 'Velocity', 'Duration']]
+        drum_pattern = [self.token_space.code(x)
+                        for x in ['Position', 'Drum', 'Program', 'Pitch', 'Velocity', 'Duration']]
+        chord_pattern = [self.token_space.code(x) for x in ['Position', 'Chord']]
+        tempo_pattern = [self.token_space.code(x) for x in ['Position', 'Tempo_Class', 'Tempo_Value']]
+        chord_labels = self.token_space.families['Chord'].labels if 'Chord' in self.token_space.families else []
+        tempo_class_starts = self.tempo_class_starts()
+        # get bar and note (no time)
         temp_notes = []
         temp_drums = []
         temp_chords = []
         temp_tempos = []
+        dropped = 0
         i = 0
-        while i < len(events):
-            if events[i].name == 'Bar' and i > 0:
-                temp_notes.append('Bar')
-                temp_drums.append('Bar')
-                temp_chords.append('Bar')
-                temp_tempos.append('Bar')
+        current_bar = 0
+        while i < len(codes):
+            if codes[i] == bar:
+                # first `Bar` is the start
+                if i > 0:
+                    current_bar += 1
                 i += 1
-            elif i < len(events) - 5 and events[i].name == 'Position' and \
-                    events[i + 1].name == 'Note' and \
-                    events[i + 2].name == 'Program' and \
-                    events[i + 3].name == 'Pitch' and \
-                    events[i + 4].name == 'Velocity' and \
-                    events[i + 5].name == 'Duration':
+            elif i < len(codes) - 5 and codes[i:i + 6] == note_pattern:
                 # start time and end time from position
-                position = int(events[i].value)
+                position = values[i]
                 # program
-                program = int(events[i + 2].value)
+                program = values[i + 2]
                 # pitch
-                pitch = int(events[i + 3].value)
+                pitch = values[i + 3]
                 # velocity
-                velocity = int(events[i + 4].value)
+                velocity = values[i + 4]
                 # duration
-                duration = events[i + 5].value * self.default_quantized_ticks
+                duration = values[i + 5] * self.default_quantized_ticks
                 # adding
-                temp_notes.append([position, program, pitch, velocity, duration])
+                temp_notes.append([current_bar, position, program, pitch, velocity, duration])
                 i += 5
-            elif i < len(events) - 5 and events[i].name == 'Position' and \
-                    events[i + 1].name == 'Drum' and \
-                    events[i + 2].name == 'Program' and \
-                    events[i + 3].name == 'Pitch' and \
-                    events[i + 4].name == 'Velocity' and \
-                    events[i + 5].name == 'Duration':
+            elif i < len(codes) - 5 and codes[i:i + 6] == drum_pattern:
                 # start time and end time from position
-                position = int(events[i].value)
+                position = values[i]
                 # program
-                program = int(events[i + 2].value)
+                program = values[i + 2]
                 # pitch
-                pitch = int(events[i + 3].value)
+                pitch = values[i + 3]
                 # velocity
-                velocity = int(events[i + 4].value)
+                velocity = values[i + 4]
                 # duration
-                duration = events[i + 5].value * self.default_quantized_ticks
+                duration = values[i + 5] * self.default_quantized_ticks
                 # adding
-                temp_drums.append([position, program, pitch, velocity, duration])
+                temp_drums.append([current_bar, position, program, pitch, velocity, duration])
                 i += 5
-            elif i < len(events) - 1 and events[i].name == 'Position' and events[i + 1].name == 'Chord':
-                position = int(events[i].value)
-                temp_chords.append([position, events[i + 1].value])
+            elif i < len(codes) - 1 and codes[i:i + 2] == chord_pattern:
+                position = values[i]
+                temp_chords.append([current_bar, position, chord_labels[values[i + 1]]])
                 i += 2
-            elif i < len(events) - 2 and events[i].name == 'Position' and \
-                    events[i + 1].name == 'Tempo_Class' and \
-                    events[i + 2].name == 'Tempo_Value':
-                position = int(events[i].value)
-                tempo = None
-                for j in range(len(self.default_tempo_intervals)):
-                    if events[i + 1].value == f'T{j}':
-                        tempo = self.default_tempo_intervals[j].start + int(events[i + 2].value)
-                if tempo is not None:
-                    temp_tempos.append([position, tempo])
+            elif i < len(codes) - 2 and codes[i:i + 3] == tempo_pattern:
+                position = values[i]
+                if values[i + 1] in tempo_class_starts:
+                    temp_tempos.append([current_bar, position, tempo_class_starts[values[i + 1]] + values[i + 2]])
                 i += 3
             else:
                 # bad case
+                dropped += 1
                 i += 1
+        # (the `Duration` left by `i += 5` of each note/drum is not dropped)
+        self.count('dropped_tokens', dropped - len(temp_notes) - len(temp_drums))
         return temp_notes, temp_drums, temp_chords, temp_tempos
 
+    def tempo_class_starts(self):
+        """ start tempo of each `Tempo_Class` label index """
+        starts = {}
+        if 'Tempo_Class' in self.token_space.families:
+            for index, label in enumerate(self.token_space.families['Tempo_Class'].labels):
+                for j in range(len(self.default_tempo_intervals)):
+                    if label == f'T{j}':
+                        starts[index] = self.default_tempo_intervals[j].start
+        return starts
+
+    def position_ticks(self, bars, positions):
+        """ start ticks of positions in bars (no `np.linspace()` for each bar) """
+        # same as `np.linspace(bar_st, bar_et, self.bar_split_fraction, endpoint=False, dtype=int)[position]`
+        return (np.asarray(positions) * (self.ticks_per_bar / self.bar_split_fraction)
+                + np.asarray(bars) * self.ticks_per_bar).astype(int)
+
     def build_notes_drums(self, temp_xs):
         xs_dict = {}
-        current_bar = 0
-        for xx in temp_xs:
-            if xx == 'Bar':
-                current_bar += 1
+        if len(temp_xs) == 0:
+            return xs_dict
+        bars, positions, programs, pitches, velocities, durations = np.array(temp_xs, dtype=int).T
+        # position (start time), duration (end time)
+        starts = self.position_ticks(bars, positions)
+        ends = starts + durations
+        for program, pitch, velocity, st, et in zip(programs.tolist(), pitches.tolist(), velocities.tolist(),
+                                                    starts.tolist(), ends.tolist()):
+            if program not in xs_dict:
+                xs_dict[program] = [miditoolkit.Note(velocity, pitch, st, et)]
             else:
-                position, program, pitch, velocity, duration = xx
-                # position (start time)
-                current_bar_st = current_bar * self.ticks_per_bar
-                current_bar_et = (current_bar + 1) * self.ticks_per_bar
-                flags = np.linspace(current_bar_st, current_bar_et, self.bar_split_fraction, endpoint=False,
-                                    dtype=int)
-                st = flags[position]
-                # duration (end time)
-                et = st + duration
-                if program not in xs_dict:
-                    xs_dict[program] = [miditoolkit.Note(velocity, pitch, st, et)]
-                else:
-                    xs_dict[program].append(miditoolkit.Note(velocity, pitch, st, et))
+                xs_dict[program].append(miditoolkit.Note(velocity, pitch, st, et))
         return xs_dict
 
     def build_tempos(self, temp_tempos):
-        tempos = []
-        current_bar = 0
-        for tempo in temp_tempos:
-            if tempo == 'Bar':
-                current_bar += 1
-            else:
-                position, value = tempo
-                # position (start time)
-                current_bar_st = current_bar * self.ticks_per_bar
-                current_bar_et = (current_bar + 1) * self.ticks_per_bar
-                flags = np.linspace(current_bar_st, current_bar_et, self.bar_split_fraction, endpoint=False,
-                                    dtype=int)
-                st = flags[position]
-                tempos.append([int(st), value])
-        return tempos
+        if len(temp_tempos) == 0:
+            return []
+        bars, positions, values = np.array(temp_tempos, dtype=int).T
+        return [[st, value] for st, value in zip(self.position_ticks(bars, positions).tolist(), values.tolist())]
 
     def build_chords(self, temp_chords):
-        chords = []
-        if len(temp_chords) > 0:
-            current_bar = 0
-            for chord in temp_chords:
-                if chord == 'Bar':
-                    current_bar += 1
-                else:
-                    position, value = chord
-                    # position (start time)
-                    current_bar_st = current_bar * self.ticks_per_bar
-                    current_bar_et = (current_bar + 1) * self.ticks_per_bar
-                    flags = np.linspace(current_bar_st, current_bar_et, self.bar_split_fraction, endpoint=False,
-                                        dtype=int)
-                    st = flags[position]
-                    chords.append([st, value])
-        return chords
+        if len(temp_chords) == 0:
+            return []
+        bars, positions, values = zip(*temp_chords)
+        return [[st, value] for st, value in zip(self.position_ticks(bars, positions).tolist(), values)]
 
-    @staticmethod
-    def to_int(string):
-        # noinspection PyBroadException
-        try:
-            return int(string)
-        except Exception:
-            return string
-
-    def words_to_events(self, words):
-        events = []
-        for word in words:
-            word_split = word.split(self.separator)
-            if self.separator not in word:
-                events.append(Event(name=word_split[0], time=None, value=None, text=None))
-            else:
-                events.append(Event(name=word_split[0], time=None, value=self.to_int(word_split[1]), text=None))
-        return events
+    def integers_to_tokens(self, integers):
+        """ family codes and values of integers (unknown integers dropped) """
+        codes, values = self.token_space.classify(integers)
+        known = codes >= 0
+        n_unknown = len(known) - int(np.count_nonzero(known))
+        self.warn('unknown_integers', n_unknown, f'{n_unknown} integers not in i2w!')
+        return codes[known].tolist(), values[known].tolist()
 
-    def integers_to_words(self, integers):
-        words = []
-        for integer in integers:
-            if integer in self.i2w:
-                words.append(self.i2w[integer])
-            else:
-                print(f'WARNING: `{integer}` not in i2w!')
-        return words
-
-    def decode(self, integers, output_path):
-        # decode to events
-        words = self.integers_to_words(integers)
-        events = self.words_to_events(words)
+    def build_midi(self, integers):
+        """ `miditoolkit` midi object of integers """
+        # decode to family codes and values
+        start = self.start_stage()
+        codes, values = self.integers_to_tokens(integers)
+        self.end_stage('integers_to_tokens', start, len(codes))
 
         # decode properties
-        temp_notes, temp_drums, temp_chords, temp_tempos = self.extract_events(events)
+        start = self.start_stage()
+        temp_notes, temp_drums, temp_chords, temp_tempos = self.extract_events(codes, values)
+        self.end_stage('extract_events', start,
+                       len(temp_notes) + len(temp_drums) + len(temp_chords) + len(temp_tempos))
         # get specific time for items
+        start = self.start_stage()
         # notes
         notes_dict = self.build_notes_drums(temp_notes)
         # drums
         drums_dict = self.build_notes_drums(temp_drums)
+        self.end_stage('build_notes_drums', start, len(temp_notes) + len(temp_drums))
+        start = self.start_stage()
         # chords
         chords = self.build_chords(temp_chords)
         # tempos
         tempos = self.build_tempos(temp_tempos)
+        self.end_stage('build_chords_tempos', start, len(chords) + len(tempos))
 
         # write MIDI
         midi = miditoolkit.midi.parser.MidiFile(ticks_per_beat=self.default_ticks_per_beat)
@@ -240,5 +233,170 @@ class MidiDecoder(Common):
                 midi.markers.append(
                     miditoolkit.midi.containers.Marker(text=c[1], time=c[0]))
 
-        # export MIDI
-        midi.dump(output_path)
+        return midi
+
+    def decode(self, integers, output_path=None, output_format='midi'):
+        """
+        decode integers to `output_format`, and export midi file to `output_path` if given:
+            * `midi`: `miditoolkit` midi object;
+            * `bytes`: standard midi file bytes;
+            * `arrays`: arrays of notes, controls and tempos as `MidiCache.midi_to_arrays()` (no markers);
+        """
+        if output_format not in self.output_formats:
+            raise ValueError(f'ERROR: output format `{output_format}` not supported!')
+        midi = self.build_midi(integers)
+        if output_path is not None or output_format == 'bytes':
+            # export MIDI
+            start = self.start_stage()
+            file = io.BytesIO()
+            midi.dump(file=file)
+            data = file.getvalue()
+            self.end_stage('dump', start, len(data))
+            if output_path is not None:
+                with open(output_path, 'wb') as f:
+                    f.write(data)
+            if output_format == 'bytes':
+                return data
+        if output_format == 'arrays':
+            from ..midi_cache import MidiCache
+            return MidiCache.midi_to_arrays(midi)
+        return midi
+
+    @staticmethod
+    def unpad(sequences, lengths=None, pad=None):
+        """ sequences (list of arrays, or rows of padded 2D array) cut by `lengths` and at first `pad` (pad/eos id) """
+        sequences = [np.asarray(sequence) for sequence in sequences]
+        if lengths is not None:
+            if len(lengths) != len(sequences):
+                raise ValueError('ERROR: numbers of sequences and lengths are different!')
+            sequences = [sequence[:length] for sequence, length in zip(sequences, lengths)]
+        if pad is not None:
+            sequences = [sequence[:np.argmax(sequence == pad)] if np.any(sequence == pad) else sequence
+                         for sequence in sequences]
+        return sequences
+
+    def decode_batch(self, sequences, lengths=None, pad=None, output_paths=None, output_format='midi', cpu_number=1,
+                     chunk_size=4):
+        """ `decode()` results of sequences in order, decoded by `cpu_number` processes (all cpus if `0`) """
+        if output_format not in self.output_formats:
+            raise ValueError(f'ERROR: output format `{output_format}` not supported!')
+        sequences = self.unpad(sequences, lengths=lengths, pad=pad)
+        if output_paths is None:
+            output_paths = [None] * len(sequences)
+        elif len(output_paths) != len(sequences):
+            raise ValueError('ERROR: numbers of sequences and output paths are different!')
+        tasks = [(sequence, output_path, output_format) for sequence, output_path in zip(sequences, output_paths)]
+        cpu_number = min(cpu_number if cpu_number > 0 else os.cpu_count(), len(tasks))
+        if cpu_number <= 1:
+            return [self.decode(integers, output_path=output_path, output_format=output_format)
+                    for integers, output_path, output_format in tasks]
+        # stats (and its hook) are not sent to workers
+        decoder = copy.copy(self)
+        decoder.stats = None
+        with multiprocessing.Pool(cpu_number, initializer=initialize_worker, initargs=(decoder,)) as pool:
+            return pool.map(decode_sequence, tasks, chunksize=chunk_size)
+
+
+class MidiStreamDecoder(object):
+    """
+    incremental decoder of integers (for generation), same items as `MidiDecoder.decode()` of all fed integers:
+        * `feed()` integers one by one or in chunks, returns `Note`/`Drum`/`Tempo`/`Chord` items completed by them;
+        * tokens of an unfinished pattern wait in `buffer` (at most one pattern).
+    """
+
+    def __init__(self, decoder):
+        self.decoder = decoder
+        token_space = decoder.token_space
+        self.id_codes, self.id_values = token_space.classification()
+        self.chord_labels = token_space.families['Chord'].labels if 'Chord' in token_space.families else []
+        self.tempo_class_starts = decoder.tempo_class_starts()
+        self.ticks_per_position = decoder.ticks_per_bar / decoder.bar_split_fraction
+        # (family codes, tokens consumed, item builder) in order of `MidiDecoder.extract_events()`
+        # (the `Duration` left by `i += 5` is skipped as bad case)
+        self.rules = [([token_space.code('Bar')], 1, self.next_bar),
+                      ([token_space.code(x) for x in ['Position', 'Note', 'Program', 'Pitch', 'Velocity', 'Duration']],
+                       6, self.note_item),
+                      ([token_space.code(x) for x in ['Position', 'Drum', 'Program', 'Pitch', 'Velocity', 'Duration']],
+                       6, self.drum_item),
+                      ([token_space.code(x) for x in ['Position', 'Chord']], 2, self.chord_item),
+                      ([token_space.code(x) for x in ['Position', 'Tempo_Class', 'Tempo_Value']], 3, self.tempo_item)]
+        # tokens waiting, number of consumed tokens
+        self.buffer = []
+        self.n_tokens = 0
+        self.current_bar = 0
+
+    def reset(self):
+        self.buffer = []
+        self.n_tokens = 0
+        self.current_bar = 0
+
+    def feed(self, integers):
+        """ items completed by an integer or integers """
+        if isinstance(integers, numbers.Integral):
+            integers = [integers]
+        items = []
+        n_unknown = 0
+        for integer in integers:
+            integer = int(integer)
+            if integer < 0 or integer >= len(self.id_codes) or self.id_codes[integer] < 0:
+                n_unknown += 1
+                continue
+            self.buffer.append((self.id_codes[integer], self.id_values[integer]))
+            # consume complete patterns (or bad tokens) at buffer head
+            while len(self.buffer) > 0:
+                consumed = self.match(items)
+                if consumed == 0:
+                    break
+                del self.buffer[:consumed]
+                self.n_tokens += consumed
+        self.decoder.warn('unknown_integers', n_unknown, f'{n_unknown} integers not in i2w!')
+        return items
+
+    def match(self, items):
+        """ number of tokens consumed at buffer head (`0` if waiting for tokens) """
+        for pattern, consumed, build in self.rules:
+            n = min(len(pattern), len(self.buffer))
+            if all(self.buffer[j][0] == pattern[j] for j in range(n)):
+                if n < len(pattern):
+                    return 0
+                item = build([value for _, value in self.buffer[:len(pattern)]])
+                if item is not None:
+                    items.append(item)
+                return consumed
+        # bad case
+        self.decoder.count('dropped_tokens', 1)
+        return 1
+
+    def tick(self, position):
+        # same as `np.linspace(bar_st, bar_et, self.bar_split_fraction, endpoint=False, dtype=int)[position]`
+        return int(position * self.ticks_per_position + self.current_bar * self.decoder.ticks_per_bar)
+
+    def next_bar(self, _):
+        # first `Bar` is the start
+        if self.n_tokens > 0:
+            self.current_bar += 1
+
+    def note_item(self, values):
+        if self.decoder.decode_note:
+            return self.build_note('Note', values)
+
+    def drum_item(self, values):
+        if self.decoder.decode_drum:
+            return self.build_note('Drum', values)
+
+    def build_note(self, name, values):
+        position, _, program, pitch, velocity, duration = values
+        start = self.tick(position)
+        return Item(name=name, start=start, end=start + duration * self.decoder.default_quantized_ticks,
+                    velocity=velocity, pitch=pitch, program=program)
+
+    def chord_item(self, values):
+        if self.decoder.decode_chord:
+            return Item(name='Chord', start=self.tick(values[0]), end=None, velocity=None,
+                        pitch=self.chord_labels[values[1]], program=None)
+
+    def tempo_item(self, values):
+        position, tempo_class, tempo_value = values
+        if self.decoder.decode_tempo and tempo_class in self.tempo_class_starts:
+            return Item(name='Tempo', start=self.tick(position), end=None, velocity=None,
+                        pitch=self.tempo_class_starts[tempo_class] + tempo_value, program=None)
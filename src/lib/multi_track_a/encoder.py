@@ -1,26 +1,29 @@
-import os
 import random
-import sys
 
 import miditoolkit
 import numpy as np
 
-sys.path.append(os.path.dirname(os.path.abspath(__file__)))
-try:
-    from chord_detect import MIDIChord
-    from common import Common, Event, Item
-except Exception:
-    raise ValueError('ERROR: cannot import!')
+from .chord_detect import MIDIChord
+from .common import Common, Event, Item, TokenSpace
 
 
 class MidiEncoder(Common):
     def __init__(self, file_path, w2i, pitch_variation_range=None,
                  velocity_scale_variation_range=None,
                  velocity_noise_scale_variation_range=None,
-                 tempo_scale_variation_range=None):
+                 tempo_scale_variation_range=None,
+                 fast=False,
+                 sparse_chord=False,
+                 midi_cache=None,
+                 stats=None):
         super().__init__()
         self.file_path = file_path
         self.w2i = w2i
+        self.fast = fast
+        self.sparse_chord = sparse_chord
+        # parsed midi cache (`MidiCache`) if any, and arrays of midi file loaded from it
+        self.midi_cache = midi_cache
+        self.midi_arrays = None
         self.pitch_variation_range = pitch_variation_range
         self.velocity_scale_variation_range = velocity_scale_variation_range
         self.velocity_noise_scale_variation_range = velocity_noise_scale_variation_range
@@ -35,7 +38,15 @@ class MidiEncoder(Common):
         self.instruments = None
         self.time_sig = None
         self.quantized_ticks = None
+        self.position_grid = None
         self.chord_method = None
+        # token id arithmetic (struct-of-arrays engine)
+        self.token_space = None
+        self.unknown_tokens = 0
+        # parsed columns of midi file (struct-of-arrays engine, shared by variations)
+        self.base_arrays = None
+        # chords of untransposed notes (rotated for pitch variations)
+        self.base_chords = None
         # common tempo is 4/4
         self.numerator = 4
         self.denominator = 4
@@ -43,33 +54,38 @@ class MidiEncoder(Common):
         self.pitch_variation = None
         self.velocity_variation = None
         self.tempo_variation = None
+        # random generator of variation (`random` module, or `random.Random` of `encode_variations()`)
+        self.rng = random
+        # stage timers and token counters (`Stats`) if instrumented
+        self.stats = stats
 
         # initialization
+        start = self.start_stage()
         self.initialize_midi(self.file_path)
+        self.end_stage('initialize_midi', start, self.midi_size)
 
     def initialize_variation(self, variation):
         if variation and self.pitch_variation_range is not None:
-            self.pitch_variation = random.randint(self.pitch_variation_range[0],
-                                                  self.pitch_variation_range[1])
+            self.pitch_variation = self.rng.randint(self.pitch_variation_range[0],
+                                                    self.pitch_variation_range[1])
         else:
             self.pitch_variation = 0
         if variation and self.velocity_scale_variation_range is not None:
-            self.velocity_variation = random.uniform(self.velocity_scale_variation_range[0],
-                                                     self.velocity_scale_variation_range[1])
+            self.velocity_variation = self.rng.uniform(self.velocity_scale_variation_range[0],
+                                                       self.velocity_scale_variation_range[1])
         else:
             self.velocity_variation = 1
         if variation and self.tempo_scale_variation_range is not None:
-            self.tempo_variation = random.uniform(self.tempo_scale_variation_range[0],
-                                                  self.tempo_scale_variation_range[1])
+            self.tempo_variation = self.rng.uniform(self.tempo_scale_variation_range[0],
+                                                    self.tempo_scale_variation_range[1])
         else:
             self.tempo_variation = 1
 
-    @staticmethod
-    def velocity_transform(velocity, scale):
+    def velocity_transform(self, velocity, scale):
         if scale > 0:
             velocity = min(int(round(scale * velocity)), 127)
         elif scale < 0:
-            diff = random.uniform(0, scale * 127)
+            diff = self.rng.uniform(0, scale * 127)
             velocity = int(round(scale * velocity + diff))
         return velocity
 
@@ -78,10 +94,47 @@ class MidiEncoder(Common):
             return velocity
         else:
             # add dynamic noise
-            noise_scale = random.uniform(self.velocity_noise_scale_variation_range[0],
-                                         self.velocity_noise_scale_variation_range[0])
+            noise_scale = self.rng.uniform(self.velocity_noise_scale_variation_range[0],
+                                           self.velocity_noise_scale_variation_range[0])
             return self.velocity_transform(velocity, noise_scale)
 
+    def velocity_array_transform(self, velocities, scales):
+        scales = np.broadcast_to(scales, np.shape(velocities))
+        scaled = np.minimum(np.round(scales * velocities).astype(int), 127)
+        negative = scales < 0
+        if np.any(negative):
+            # random shift of each velocity of negative scale (drawn in order as `velocity_transform()`)
+            diffs = np.array([self.rng.uniform(0, scale * 127) for scale in scales[negative].tolist()])
+            scaled[negative] = np.round(scales[negative] * velocities[negative] + diffs).astype(int)
+        return np.where(scales != 0, scaled, velocities)
+
+    def velocity_noise_array_add(self, velocities):
+        if self.velocity_noise_scale_variation_range is None:
+            return velocities
+        else:
+            # add dynamic noise
+            noise_scales = np.array([self.rng.uniform(self.velocity_noise_scale_variation_range[0],
+                                                      self.velocity_noise_scale_variation_range[0])
+                                     for _ in range(len(velocities))])
+            return self.velocity_array_transform(velocities, noise_scales)
+
+    def velocity_array_variation(self, velocities):
+        """ `velocity_transform()` then `velocity_noise_add()` of velocities, same random draws as item engine """
+        noise_range = self.velocity_noise_scale_variation_range
+        if noise_range is not None and (self.velocity_variation < 0 or min(noise_range) < 0):
+            # random shifts and noise scales are drawn alternately for each velocity
+            return np.array([self.velocity_noise_add(self.velocity_transform(velocity, self.velocity_variation))
+                             for velocity in velocities.tolist()], dtype=int).reshape(-1)
+        velocities = self.velocity_array_transform(velocities, self.velocity_variation)
+        return self.velocity_noise_array_add(velocities)
+
+    def pitch_array_transform(self, pitches):
+        target_pitches = pitches + self.pitch_variation
+        # fold into range by octaves
+        target_pitches = np.where(target_pitches > 127, target_pitches - (target_pitches - 116) // 12 * 12,
+                                  target_pitches)
+        return np.where(target_pitches < 0, target_pitches + (11 - target_pitches) // 12 * 12, target_pitches)
+
     def pitch_transform(self, pitch):
         target_pitch = pitch + self.pitch_variation
         if target_pitch > 127:
@@ -96,12 +149,17 @@ class MidiEncoder(Common):
         return int(tempo * self.tempo_variation)
 
     def initialize_midi(self, path):
-        # read midi now
-        midi_obj = miditoolkit.midi.parser.MidiFile(path)
+        # read midi now (through cache if any)
+        if self.midi_cache is None:
+            midi_obj = miditoolkit.midi.parser.MidiFile(path)
+            self.instruments = midi_obj.instruments
+        else:
+            # notes are read from cached arrays by `parse_arrays()`, instruments are built for item engine only
+            self.midi_arrays = self.midi_cache.load_arrays(path)
+            midi_obj = self.midi_cache.arrays_to_midi(self.midi_arrays, with_instruments=False)
         self.ticks_per_beat = midi_obj.ticks_per_beat
         self.max_tick = midi_obj.max_tick
         self.tempo_changes = midi_obj.tempo_changes
-        self.instruments = midi_obj.instruments
         if len(midi_obj.time_signature_changes) > 0:
             # TODO: assume, time signature will not change
             self.time_sig = midi_obj.time_signature_changes[0]
@@ -110,9 +168,24 @@ class MidiEncoder(Common):
         self.max_duration_splits = self.bar_split_fraction * self.max_duration_bars - 1
         self.quantized_beat_splits = self.bar_split_fraction / self.numerator
         self.quantized_ticks = int(self.ticks_per_beat / self.quantized_beat_splits)
-        self.chord_method = MIDIChord(numerator=self.numerator, ticks_per_beat=self.ticks_per_beat)
+        self.position_grid = np.linspace(0, self.ticks_per_bar, self.bar_split_fraction, endpoint=False)
+        self.chord_method = MIDIChord(numerator=self.numerator, ticks_per_beat=self.ticks_per_beat,
+                                      sparse=self.sparse_chord)
+
+    def load_instruments(self):
+        """ `miditoolkit` instruments of midi file (built from cached arrays at first use) """
+        if self.instruments is None:
+            self.instruments = self.midi_cache.arrays_to_midi(self.midi_arrays).instruments
+        return self.instruments
+
+    def midi_size(self):
+        """ number of notes and drums of midi file """
+        if self.instruments is None:
+            return len(self.midi_arrays['notes'])
+        return sum(len(instrument.notes) for instrument in self.instruments)
 
     def read_items(self):
+        self.load_instruments()
         # note
         notes = [self.instruments[i].notes for i in range(len(self.instruments))
                  if not self.instruments[i].is_drum]
@@ -154,42 +227,31 @@ class MidiEncoder(Common):
                     program=drum_programs[i]))
         drum_items.sort(key=lambda x: x.start)
 
-        # tempo
-        tempo_items = []
-        for tempo in self.tempo_changes:
-            tempo_items.append(Item(
-                name='Tempo',
-                start=tempo.time,
-                end=None,
-                velocity=None,
-                pitch=self.tempo_transform(tempo.tempo),
-                program=None))
-        tempo_items.sort(key=lambda x: x.start)
+        # tempo (kept as arrays, see `tempo_items()`)
+        tempo_table = self.beat_tempos()
+        return note_items, drum_items, tempo_table
 
-        # expand to all beat
-        max_tick = tempo_items[-1].start
-        existing_ticks = {item.start: item.pitch for item in tempo_items}
-        wanted_ticks = np.arange(0, max_tick + 1, self.ticks_per_beat)
-        output = []
-        for tick in wanted_ticks:
-            if tick in existing_ticks:
-                output.append(Item(
-                    name='Tempo',
-                    start=tick,
-                    end=None,
-                    velocity=None,
-                    pitch=existing_ticks[tick],
-                    program=None))
-            else:
-                output.append(Item(
-                    name='Tempo',
-                    start=tick,
-                    end=None,
-                    velocity=None,
-                    pitch=output[-1].pitch,
-                    program=None))
-        tempo_items = output
-        return note_items, drum_items, tempo_items
+    def beat_tempos(self):
+        """ tempo of every beat until the last tempo change, forward filled from tempo changes on beats """
+        times = np.array([tempo.time for tempo in self.tempo_changes], dtype=int)
+        tempos = np.array([self.tempo_transform(tempo.tempo) for tempo in self.tempo_changes], dtype=int)
+        wanted_ticks = np.arange(0, times.max() + 1, self.ticks_per_beat)
+        # tempo changes on beats, the last one wins for the same tick
+        order = np.argsort(times, kind='stable')
+        times, tempos = times[order], tempos[order]
+        on_beat = (times % self.ticks_per_beat == 0) & np.append(times[1:] != times[:-1], True)
+        times, tempos = times[on_beat], tempos[on_beat]
+        # (beats before the first tempo change take its tempo)
+        index = np.maximum(np.searchsorted(times, wanted_ticks, side='right') - 1, 0)
+        return {'start': wanted_ticks, 'tempo': tempos[index]}
+
+    @staticmethod
+    def tempo_items(tempo_table, max_time, ticks_per_bar):
+        """ tempo items of beats before the last downbeat (the others are not grouped) """
+        n_beats = np.searchsorted(tempo_table['start'], -(-max_time // ticks_per_bar) * ticks_per_bar)
+        return [Item(name='Tempo', start=start, end=None, velocity=None, pitch=tempo, program=None)
+                for start, tempo in zip(tempo_table['start'][:n_beats].tolist(),
+                                        tempo_table['tempo'][:n_beats].tolist())]
 
     @staticmethod
     def quantize_items(items, ticks):
@@ -201,8 +263,38 @@ class MidiEncoder(Common):
             item.end += shift_start
         return items
 
+    def rotate_chord(self, chord, shift):
+        """ chord name (`root:quality` or `root:quality/bass`) transposed by `shift` semitones """
+        if chord == 'N:N':
+            return chord
+        pitch_classes = self.chord_method.PITCH_CLASSES
+        root, name = chord.split(':')
+        quality, _, bass = name.partition('/')
+        root = pitch_classes[(pitch_classes.index(root) + shift) % 12]
+        if bass:
+            return f'{root}:{quality}/{pitch_classes[(pitch_classes.index(bass) + shift) % 12]}'
+        return f'{root}:{quality}'
+
+    def detect_chords(self, starts, ends, pitches, velocities):
+        """ chords of notes sorted by start, rotated from `base_chords` if pitch variation only shifts notes """
+        base_table = self.parse_arrays()[0]
+        base_pitches = base_table['pitch'][base_table['order']]
+        base_velocities = base_table['velocity'][base_table['order']]
+        # octave folding at edges, or notes silenced by velocity variation, need detection again
+        if (not np.array_equal(pitches, base_pitches + self.pitch_variation)
+                or not np.array_equal(velocities > 0, base_velocities > 0)):
+            return self.chord_method.extract_from_arrays(starts=starts, ends=ends, pitches=pitches,
+                                                         velocities=velocities)
+        if self.base_chords is None:
+            self.base_chords = self.chord_method.extract_from_arrays(starts=starts, ends=ends, pitches=base_pitches,
+                                                                     velocities=base_velocities)
+        return [[start, end, self.rotate_chord(chord, self.pitch_variation)] for start, end, chord in self.base_chords]
+
     def extract_chords(self, items):
-        chords = self.chord_method.extract(notes=items)
+        chords = self.detect_chords(starts=np.array([item.start for item in items], dtype=int),
+                                    ends=np.array([item.end for item in items], dtype=int),
+                                    pitches=np.array([item.pitch for item in items], dtype=int),
+                                    velocities=np.array([item.velocity for item in items], dtype=int))
         output = []
         for chord in chords:
             output.append(Item(
@@ -217,24 +309,66 @@ class MidiEncoder(Common):
 
     @staticmethod
     def group_items(items, max_time, ticks_per_bar):
+        return list(MidiEncoder.iter_group_items(items, max_time, ticks_per_bar))
+
+    @staticmethod
+    def iter_group_items(items, max_time, ticks_per_bar):
+        """ generator of bar groups (downbeat, items, next downbeat) of `group_items()` """
         items.sort(key=lambda x: x.start)
         downbeats = np.arange(0, max_time + ticks_per_bar, ticks_per_bar)
-        groups = []
-        for db1, db2 in zip(downbeats[:-1], downbeats[1:]):
-            insiders = []
-            for item in items:
-                if (item.start >= db1) and (item.start < db2):
-                    insiders.append(item)
-            insiders.sort(key=lambda x: x.start)
-            overall = [db1] + insiders + [db2]
-            groups.append(overall)
-        return groups
+        # items are sorted, split them by bar in one pass
+        starts = [item.start for item in items]
+        splits = np.searchsorted(starts, downbeats, side='left').tolist()
+        downbeats = downbeats.tolist()
+        for i in range(len(downbeats) - 1):
+            insiders = items[splits[i]:splits[i + 1]]
+            yield [downbeats[i]] + insiders + [downbeats[i + 1]]
+
+    def position_index(self, bar_starts, starts):
+        # nearest flag of the position grid (first one for ties)
+        offsets = starts - bar_starts
+        right = np.clip(np.searchsorted(self.position_grid, offsets), 1, self.bar_split_fraction - 1)
+        left = right - 1
+        left_distance = np.abs(self.position_grid[left] + bar_starts - starts)
+        right_distance = np.abs(self.position_grid[right] + bar_starts - starts)
+        return np.where(right_distance < left_distance, right, left)
+
+    def duration_index(self, starts, ends):
+        durations = np.round((ends - starts) / self.quantized_ticks).astype(int)
+        return np.clip(durations, 1, self.max_duration_splits)
+
+    def tempo_index(self, tempos):
+        tempo_starts = np.array([interval.start for interval in self.default_tempo_intervals])
+        # limit to range
+        tempos = np.clip(tempos, tempo_starts[0], self.default_tempo_intervals[-1].stop - 1)
+        tempo_classes = np.searchsorted(tempo_starts, tempos, side='right') - 1
+        return tempo_classes, tempos - tempo_starts[tempo_classes]
+
+    def item_values(self, groups):
+        """ position, duration and tempo class/value of all grouped items as integer arrays """
+        bar_starts = []
+        starts = []
+        ends = []
+        tempos = []
+        for group in groups:
+            for item in group[1:-1]:
+                bar_starts.append(group[0])
+                starts.append(item.start)
+                ends.append(item.end if item.name in ['Note', 'Drum'] else item.start)
+                tempos.append(int(item.pitch) if item.name == 'Tempo' else 0)
+        bar_starts = np.array(bar_starts, dtype=int)
+        starts = np.array(starts, dtype=int)
+        positions = self.position_index(bar_starts, starts)
+        durations = self.duration_index(starts, np.array(ends, dtype=int))
+        tempo_classes, tempo_values = self.tempo_index(np.array(tempos, dtype=int))
+        return positions, durations, tempo_classes, tempo_values
 
     def item_to_event(self, groups):
+        positions, durations, tempo_classes, tempo_values = self.item_values(groups)
         events = []
         n_downbeat = 0
+        k = 0
         for i in range(len(groups)):
-            bar_st, bar_et = groups[i][0], groups[i][-1]
             n_downbeat += 1
             events.append(Event(
                 name='Bar',
@@ -243,8 +377,7 @@ class MidiEncoder(Common):
                 text=f'{n_downbeat}'))
             for item in groups[i][1:-1]:
                 # position (required)
-                flags = np.linspace(bar_st, bar_et, self.bar_split_fraction, endpoint=False)
-                value = np.argmin(abs(flags - item.start))
+                value = int(positions[k])
                 events.append(Event(
                     name='Position',
                     time=item.start,
@@ -279,7 +412,7 @@ class MidiEncoder(Common):
                         text=f'{item.velocity}/{128}'))
                     # duration
                     duration = item.end - item.start
-                    value = max(min(int(round(duration / self.quantized_ticks)), self.max_duration_splits), 1)
+                    value = int(durations[k])
                     events.append(Event(
                         name='Duration',
                         time=item.start,
@@ -312,7 +445,7 @@ class MidiEncoder(Common):
                         text=f'{item.velocity}/{128}'))
                     # duration
                     duration = item.end - item.start
-                    value = max(min(int(round(duration / self.quantized_ticks)), self.max_duration_splits), 1)
+                    value = int(durations[k])
                     events.append(Event(
                         name='Duration',
                         time=item.start,
@@ -325,19 +458,9 @@ class MidiEncoder(Common):
                         value=item.pitch,
                         text=f'{item.pitch}'))
                 elif item.name == 'Tempo':
-                    tempo = int(item.pitch)
-                    # limit to range
-                    tempo = max(self.default_tempo_intervals[0].start, tempo)
-                    tempo = min(self.default_tempo_intervals[-1].stop - 1, tempo)
-                    tempo_style = tempo_value = None
-                    for j in range(len(self.default_tempo_intervals)):
-                        if tempo in self.default_tempo_intervals[j]:
-                            tempo_style = Event('Tempo_Class', item.start, f'T{j}', None)
-                            tempo_value = Event('Tempo_Value', item.start,
-                                                tempo - self.default_tempo_intervals[j].start, None)
-                    if tempo_value is not None and tempo_style is not None:
-                        events.append(tempo_style)
-                        events.append(tempo_value)
+                    events.append(Event('Tempo_Class', item.start, f'T{tempo_classes[k]}', None))
+                    events.append(Event('Tempo_Value', item.start, int(tempo_values[k]), None))
+                k += 1
         return events
 
     def events_to_words(self, events):
@@ -355,35 +478,274 @@ class MidiEncoder(Common):
             if word in self.w2i:
                 integers.append(self.w2i[word])
             else:
-                print(f'WARNING: `{word}` not in w2i!')
+                self.unknown_tokens += 1
         return integers
 
-    def encode(self, variation=True):
-        # get new initialize variation
-        self.initialize_variation(variation)
+    def count_unknown(self, ids):
+        self.unknown_tokens += int(np.sum(ids < 0))
+        return ids
+
+    def token_ids(self, family, values):
+        """ `base + value` of family (unknown or out of range counted) """
+        return self.count_unknown(self.token_space.ids(family, values))
+
+    def warn_unknown_tokens(self):
+        self.warn('unknown_tokens', self.unknown_tokens, f'{self.unknown_tokens} tokens not in w2i!')
+
+    def parse_arrays(self):
+        """ note and drum columns (in file order, with order by start) of midi file, parsed once """
+        if self.base_arrays is None and self.midi_arrays is not None:
+            # columns of cached arrays (instrument rows: program, is drum, number of notes, number of controls)
+            instruments = np.asarray(self.midi_arrays['instruments'], dtype=int)
+            notes = np.asarray(self.midi_arrays['notes'], dtype=int)
+            note_drums = np.repeat(instruments[:, 1], instruments[:, 2]) > 0
+            note_programs = np.repeat(instruments[:, 0], instruments[:, 2])
+            self.base_arrays = []
+            for is_drum in [False, True]:
+                selected = note_drums == is_drum
+                self.base_arrays.append({'order': np.argsort(notes[selected, 0], kind='stable'),
+                                         'start': notes[selected, 0],
+                                         'end': notes[selected, 1],
+                                         'pitch': notes[selected, 2],
+                                         'velocity': notes[selected, 3],
+                                         'program': note_programs[selected]})
+        if self.base_arrays is None:
+            self.base_arrays = []
+            for is_drum in [False, True]:
+                starts, ends, pitches, velocities, programs = [], [], [], [], []
+                for instrument in self.instruments:
+                    if instrument.is_drum == is_drum:
+                        for note in instrument.notes:
+                            starts.append(note.start)
+                            ends.append(note.end)
+                            pitches.append(note.pitch)
+                            velocities.append(note.velocity)
+                        programs.extend([instrument.program] * len(instrument.notes))
+                self.base_arrays.append({'order': np.argsort(starts, kind='stable'),
+                                         'start': np.array(starts, dtype=int),
+                                         'end': np.array(ends, dtype=int),
+                                         'pitch': np.array(pitches, dtype=int),
+                                         'velocity': np.array(velocities, dtype=int),
+                                         'program': np.array(programs, dtype=int)})
+        return self.base_arrays
+
+    def read_arrays(self):
+        """ struct-of-arrays counterpart of `read_items()` """
+        tables = []
+        for is_drum, base_table in zip([False, True], self.parse_arrays()):
+            velocities = self.velocity_array_variation(base_table['velocity'])
+            pitches = base_table['pitch']
+            if not is_drum:
+                pitches = self.pitch_array_transform(pitches)
+            order = base_table['order']
+            tables.append({'start': base_table['start'][order],
+                           'end': base_table['end'][order],
+                           'pitch': pitches[order],
+                           'velocity': velocities[order],
+                           'program': base_table['program'][order]})
+        note_table, drum_table = tables
+
+        # tempo (expand to all beat)
+        tempo_table = self.beat_tempos()
+        return note_table, drum_table, tempo_table
+
+    @staticmethod
+    def quantize_arrays(table, ticks):
+        quantized_starts = np.round(table['start'] / ticks).astype(int) * ticks
+        shift_starts = quantized_starts - table['start']
+        table['start'] = table['start'] + shift_starts
+        table['end'] = table['end'] + shift_starts
+        return table
+
+    def extract_chord_arrays(self, table):
+        chords = self.detect_chords(starts=table['start'], ends=table['end'], pitches=table['pitch'],
+                                    velocities=table['velocity'])
+        # chord name will not include `/` bass note part
+        return {'start': np.array([chord[0] for chord in chords], dtype=int),
+                'chord': self.token_space.ids('Chord', [chord[2].split('/')[0] for chord in chords])}
+
+    @staticmethod
+    def group_arrays(tables, max_time, ticks_per_bar):
+        """ combine tables sorted by start, keep items within bars and give their bar index """
+        columns = ['kind', 'start', 'end', 'program', 'pitch', 'velocity', 'tempo', 'chord']
+        combined = {column: [] for column in columns}
+        for kind, table in enumerate(tables):
+            if table is None:
+                continue
+            length = len(table['start'])
+            for column in columns:
+                if column == 'kind':
+                    combined[column].append(np.full(length, kind))
+                elif column == 'end':
+                    combined[column].append(table.get(column, table['start']))
+                else:
+                    combined[column].append(table.get(column, np.zeros(length, dtype=int)))
+        combined = {column: np.concatenate(values).astype(int) for column, values in combined.items()}
+        order = np.argsort(combined['start'], kind='stable')
+        downbeats = np.arange(0, max_time + ticks_per_bar, ticks_per_bar)
+        starts = combined['start'][order]
+        order = order[(starts >= downbeats[0]) & (starts < downbeats[-1])]
+        combined = {column: values[order] for column, values in combined.items()}
+        combined['bar'] = combined['start'] // ticks_per_bar
+        return combined, len(downbeats) - 1
+
+    def arrays_to_integers(self, combined, n_bars):
+        """ item tokens as rows: `Bar` rows, then `Position` and its properties """
+        kinds, bars = combined['kind'], combined['bar']
+        positions = self.position_index(bars * self.ticks_per_bar, combined['start'])
+        durations = self.duration_index(combined['start'], combined['end'])
+        tempo_classes, tempo_values = self.tempo_index(combined['tempo'])
+        rows = np.full((len(kinds) + n_bars, 6), -1)
+        bar_rows = np.arange(n_bars) + np.searchsorted(bars, np.arange(n_bars))
+        rows[bar_rows, 0] = self.token_ids('Bar', np.zeros(n_bars, dtype=int))
+        item_rows = np.arange(len(kinds)) + bars + 1
+        rows[item_rows, 0] = self.token_ids('Position', positions)
+        for kind, name in enumerate(['Note', 'Drum']):
+            mask = kinds == kind
+            rows[item_rows[mask], 1] = self.token_ids(name, np.zeros(np.sum(mask), dtype=int))
+            rows[item_rows[mask], 2] = self.token_ids('Program', combined['program'][mask])
+            rows[item_rows[mask], 3] = self.token_ids('Pitch', combined['pitch'][mask])
+            rows[item_rows[mask], 4] = self.token_ids('Velocity', combined['velocity'][mask])
+            rows[item_rows[mask], 5] = self.token_ids('Duration', durations[mask])
+        mask = kinds == 2
+        tempo_class_ids = self.token_space.ids('Tempo_Class',
+                                               [f'T{j}' for j in range(len(self.default_tempo_intervals))])
+        rows[item_rows[mask], 1] = self.count_unknown(tempo_class_ids[tempo_classes[mask]])
+        rows[item_rows[mask], 2] = self.token_ids('Tempo_Value', tempo_values[mask])
+        mask = kinds == 3
+        rows[item_rows[mask], 1] = self.count_unknown(combined['chord'][mask])
+        return rows[rows >= 0]
+
+    def item_groups(self):
+        """ items (of current variation) grouped by bar """
+        all_items, max_time = self.combined_items()
+        # group items
+        start = self.start_stage()
+        groups = self.group_items(all_items, max_time,
+                                  ticks_per_bar=self.ticks_per_beat * self.numerator)
+        self.end_stage('group_items', start, len(all_items))
+        return groups
+
+    def combined_items(self):
+        """ items (of current variation) of all elements, and end time of notes """
         # convert to items
-        note_items, drum_items, tempo_items = self.read_items()
+        start = self.start_stage()
+        note_items, drum_items, tempo_table = self.read_items()
+        self.end_stage('read_items', start, len(note_items) + len(drum_items))
         # quantize notes / drum items
+        start = self.start_stage()
         note_items = self.quantize_items(note_items, ticks=self.quantized_ticks)
         drum_items = self.quantize_items(drum_items, ticks=self.quantized_ticks)
+        self.end_stage('quantize_items', start, len(note_items) + len(drum_items))
         # extract chord
+        start = self.start_stage()
         chord_items = self.extract_chords(note_items)
+        self.end_stage('extract_chords', start, len(chord_items))
         # combine items (with switch)
         all_items = []
         if self.with_note:
             all_items.extend(note_items)
         if self.with_drum:
             all_items.extend(drum_items)
+        max_time = note_items[-1].end
         if self.with_tempo:
-            all_items.extend(tempo_items)
+            all_items.extend(self.tempo_items(tempo_table, max_time,
+                                              ticks_per_bar=self.ticks_per_beat * self.numerator))
         if self.with_chord:
             all_items.extend(chord_items)
-        max_time = note_items[-1].end
-        # group items
-        groups = self.group_items(all_items, max_time,
-                                  ticks_per_bar=self.ticks_per_beat * self.numerator)
+        return all_items, max_time
+
+    def groups_to_integers(self, groups):
+        """ integers of grouped items (events and words on the way) """
+        start = self.start_stage()
         events = self.item_to_event(groups)
+        self.end_stage('item_to_event', start, len(events))
+        start = self.start_stage()
         words = self.events_to_words(events)
+        self.end_stage('events_to_words', start, len(words))
+        start = self.start_stage()
         ints = self.words_to_integers(words)
+        self.end_stage('words_to_integers', start, len(ints))
+        return ints
+
+    def encode_items(self, variation=True):
+        self.unknown_tokens = 0
+        # get new initialize variation
+        self.initialize_variation(variation)
+        groups = self.item_groups()
+        ints = self.groups_to_integers(groups)
+        self.warn_unknown_tokens()
         ints = np.array(ints)
         return ints
+
+    def iter_encode(self, variation=True):
+        """
+        generator of integers bar by bar (`Bar` and its elements), concatenated as `encode()`:
+            * items of whole midi are read first (random variations are drawn in order of notes, chords span bars);
+            * bars are grouped, and their events, words and integers are made one at a time;
+            * always by item engine (struct-of-arrays engine makes integers of all bars at once);
+        """
+        self.unknown_tokens = 0
+        # get new initialize variation
+        self.initialize_variation(variation)
+        all_items, max_time = self.combined_items()
+        for group in self.iter_group_items(all_items, max_time, ticks_per_bar=self.ticks_per_beat * self.numerator):
+            yield np.array(self.groups_to_integers([group]))
+        self.warn_unknown_tokens()
+
+    def encode_fast(self, variation=True):
+        """ struct-of-arrays engine, same integers as `encode_items()` without `Item`/`Event` objects """
+        if self.token_space is None:
+            self.token_space = TokenSpace(self.w2i, self.separator)
+        self.unknown_tokens = 0
+        # get new initialize variation
+        self.initialize_variation(variation)
+        # convert to arrays
+        start = self.start_stage()
+        note_table, drum_table, tempo_table = self.read_arrays()
+        self.end_stage('read_arrays', start, len(note_table['start']) + len(drum_table['start']))
+        # quantize notes / drum arrays
+        start = self.start_stage()
+        note_table = self.quantize_arrays(note_table, ticks=self.quantized_ticks)
+        drum_table = self.quantize_arrays(drum_table, ticks=self.quantized_ticks)
+        self.end_stage('quantize_arrays', start, len(note_table['start']) + len(drum_table['start']))
+        # extract chord
+        start = self.start_stage()
+        chord_table = self.extract_chord_arrays(note_table) if self.with_chord else None
+        self.end_stage('extract_chord_arrays', start, 0 if chord_table is None else len(chord_table['start']))
+        max_time = note_table['end'][-1]
+        # group arrays (with switch)
+        start = self.start_stage()
+        combined, n_bars = self.group_arrays([note_table if self.with_note else None,
+                                              drum_table if self.with_drum else None,
+                                              tempo_table if self.with_tempo else None,
+                                              chord_table],
+                                             max_time, ticks_per_bar=self.ticks_per_bar)
+        self.end_stage('group_arrays', start, len(combined['start']))
+        start = self.start_stage()
+        ints = self.arrays_to_integers(combined, n_bars)
+        self.end_stage('arrays_to_integers', start, len(ints))
+        self.warn_unknown_tokens()
+        return ints
+
+    def encode(self, variation=True):
+        if self.fast:
+            return self.encode_fast(variation)
+        return self.encode_items(variation)
+
+    def encode_variations(self, k, seed=None):
+        """ `k` variations by struct-of-arrays engine on one parse of midi file (`seed` for own random generator) """
+        rng = self.rng
+        if seed is not None:
+            self.rng = random.Random(seed)
+        try:
+            return [self.encode_fast(variation=True) for _ in range(k)]
+        finally:
+            self.rng = rng
+
+    def cross_check(self, variation=True):
+        """ check `encode_fast()` against `encode_items()` under same random state """
+        state = self.rng.getstate()
+        ints = self.encode_items(variation)
+        self.rng.setstate(state)
+        return np.array_equal(ints, self.encode_fast(variation))
@@ -1,10 +1,16 @@
-import os
-import sys
+from .common import Stats
+from .decoder import MidiDecoder, MidiStreamDecoder
+from .event_dict import EventDict
 
-sys.path.append(os.path.dirname(os.path.abspath(__file__)))
-try:
-    from decoder import MidiDecoder
-    from encoder import MidiEncoder
-    from event_dict import EventDict
-except Exception:
-    raise ValueError('ERROR: cannot import!')
+__all__ = ['EventDict', 'MidiCache', 'MidiDecoder', 'MidiEncoder', 'MidiStreamDecoder', 'Stats']
+
+
+def __getattr__(name):
+    # midi parsing (`miditoolkit`) is imported at first use
+    if name == 'MidiEncoder':
+        from .encoder import MidiEncoder
+        return MidiEncoder
+    if name == 'MidiCache':
+        from ..midi_cache import MidiCache
+        return MidiCache
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
@@ -1,4 +1,5 @@
-import miditoolkit
+import bisect
+
 import numpy as np
 
 
@@ -6,10 +7,14 @@ class MIDIChord(object):
     """
     ref: https://github.com/YatingMusic/remi
     """
+    # chord lookup table of every chroma mask (shared by instances)
+    chord_table = None
 
-    def __init__(self, numerator=4, ticks_per_beat=480):
+    def __init__(self, numerator=4, ticks_per_beat=480, sparse=False):
         self.numerator = numerator
         self.ticks_per_beat = ticks_per_beat
+        # sweep note intervals instead of per-beat tables (memory proportional to notes)
+        self.sparse = sparse
         # define pitch classes
         self.PITCH_CLASSES = ['C', 'C#', 'D', 'D#', 'E', 'F', 'F#', 'G', 'G#', 'A', 'A#', 'B']
         # define chord maps (required)
@@ -37,8 +42,13 @@ class MIDIChord(object):
                                   'aug': [1, 3, 6, 7, 10],
                                   'dom': [1, 3, 6, 8, 11]}
 
+        # qualities of chord lookup table
+        self.QUALITIES = ['None'] + list(self.CHORD_MAPS.keys())
+
         # calculate
         self.beats_to_capture = self.calculate_beats_to_capture()
+        if MIDIChord.chord_table is None:
+            MIDIChord.chord_table = self.build_chord_table()
 
     def calculate_beats_to_capture(self):
         beats_to_capture = []
@@ -55,12 +65,59 @@ class MIDIChord(object):
             beats_to_capture.extend(tmp)
         return beats_to_capture
 
+    def beat_tables(self, starts, ends, pitches, velocities, max_tick):
+        """ per-beat chroma prefix sums and lowest pitch of each pitch class """
+        n_beats = -(-max_tick // self.ticks_per_beat)
+        # keep notes with zero length (set to 1), discard notes having no velocity or starting after `max_tick`
+        ends = np.minimum(np.where(ends == starts, ends + 1, ends), max_tick)
+        keep = (velocities > 0) & (ends > starts)
+        first_beats = starts[keep] // self.ticks_per_beat
+        last_beats = (ends[keep] - 1) // self.ticks_per_beat
+        # pitch occupancy of every beat (padded to 11 octaves)
+        occupancy = np.zeros((n_beats + 1, 132), dtype=int)
+        np.add.at(occupancy, (first_beats, pitches[keep]), 1)
+        np.add.at(occupancy, (last_beats + 1, pitches[keep]), -1)
+        np.cumsum(occupancy, axis=0, out=occupancy)
+        present = occupancy[:n_beats].reshape(n_beats, 11, 12) > 0
+        chroma = present.any(axis=1)
+        chroma_prefix = np.zeros((n_beats + 1, 12), dtype=int)
+        np.cumsum(chroma, axis=0, out=chroma_prefix[1:])
+        lowest = np.where(chroma, np.argmax(present, axis=1) * 12 + np.arange(12), 128)
+        return chroma_prefix, lowest
+
+    def note_segments(self, starts, ends, pitches, velocities, max_tick):
+        """ sweep beats with active notes: first beat, chroma mask and lowest pitch of each pitch class of segments """
+        # keep notes with zero length (set to 1), discard notes having no velocity or starting after `max_tick`
+        ends = np.minimum(np.where(ends == starts, ends + 1, ends), max_tick)
+        keep = (velocities > 0) & (ends > starts)
+        n_notes = int(np.sum(keep))
+        # note boundaries (with an empty boundary at beat 0) sorted by beat
+        beats = np.concatenate([[0], starts[keep] // self.ticks_per_beat, (ends[keep] - 1) // self.ticks_per_beat + 1])
+        boundary_pitches = np.concatenate([[0], pitches[keep], pitches[keep]])
+        deltas = np.concatenate([[0], np.ones(n_notes, dtype=int), -np.ones(n_notes, dtype=int)])
+        order = np.argsort(beats, kind='stable')
+        segment_beats, bounds = np.unique(beats[order], return_index=True)
+        bounds = np.append(bounds, len(order))
+        # active notes of each pitch
+        active = np.zeros(132, dtype=int)
+        masks = []
+        lowest = []
+        for i in range(len(segment_beats)):
+            boundaries = order[bounds[i]:bounds[i + 1]]
+            np.add.at(active, boundary_pitches[boundaries], deltas[boundaries])
+            present = active.reshape(11, 12) > 0
+            chroma = present.any(axis=0)
+            masks.append(int(chroma @ (1 << np.arange(12))))
+            lowest.append(np.where(chroma, np.argmax(present, axis=0) * 12 + np.arange(12), 128).tolist())
+        return segment_beats.tolist(), masks, lowest
+
     @staticmethod
-    def note2pianoroll(notes, max_tick, ticks_per_beat):
-        return miditoolkit.pianoroll.parser.notes2pianoroll(
-            note_stream_ori=notes,
-            max_tick=max_tick,
-            ticks_per_beat=ticks_per_beat)
+    def window_lowest(lowest, n_window_beats):
+        """ lowest pitch of each pitch class over windows of `n_window_beats` beats (sliding minimum) """
+        window = lowest.copy()
+        for shift in range(1, min(n_window_beats, len(lowest))):
+            np.minimum(window[:-shift], lowest[shift:], out=window[:-shift])
+        return window
 
     @staticmethod
     def sequencing(chroma):
@@ -115,41 +172,56 @@ class MIDIChord(object):
         return scores, qualities
 
     def find_chord(self, pianoroll):
-        chroma = miditoolkit.pianoroll.utils.tochroma(pianoroll=pianoroll)
-        chroma = np.sum(chroma, axis=0)
-        chroma = np.array([1 if c else 0 for c in chroma])
-        if np.sum(chroma) == 0:
+        pitches = np.sum(pianoroll, axis=0)
+        pitches = np.concatenate([pitches, np.zeros(132 - len(pitches), dtype=pitches.dtype)]).reshape(11, 12) > 0
+        chroma = pitches.any(axis=0)
+        lowest = np.where(chroma, np.argmax(pitches, axis=0) * 12 + np.arange(12), 128)
+        return self.find_chord_from_chroma(chroma=chroma.astype(int), lowest=lowest)
+
+    def build_chord_table(self):
+        """ scores and qualities of every root for all 4096 chroma masks, and the roots having best score """
+        scores = np.zeros((4096, 12), dtype=int)
+        qualities = np.zeros((4096, 12), dtype=int)
+        best_roots = np.zeros((4096, 12), dtype=bool)
+        for mask in range(1, 4096):
+            notes = [c for c in range(12) if mask >> c & 1]
+            # same as `sequencing()`
+            candidates = {root_note: sorted((n - root_note) % 12 for n in notes) for root_note in notes}
+            _scores, _qualities = self.scoring(candidates=candidates)
+            for root_note, score in _scores.items():
+                scores[mask, root_note] = score
+                qualities[mask, root_note] = self.QUALITIES.index(_qualities[root_note])
+            _max = max(_scores.values())
+            best_roots[mask] = [_scores.get(c) == _max for c in range(12)]
+        return scores, qualities, best_roots
+
+    def find_chords(self, chroma, lowest):
+        """ root, quality, bass and score indices of windows (rows of `chroma` and `lowest`) by table lookup """
+        scores, qualities, best_roots = self.chord_table
+        masks = chroma.astype(int) @ (1 << np.arange(12))
+        # bass note is the lowest pitch, root note of best score ties break by lowest pitch
+        bass_notes = np.argmin(lowest, axis=1)
+        root_notes = np.argmin(np.where(best_roots[masks], lowest, 129), axis=1)
+        return masks, root_notes, qualities[masks, root_notes], bass_notes, scores[masks, root_notes]
+
+    def find_chord_from_chroma(self, chroma, lowest):
+        masks, root_notes, qualities, bass_notes, scores = self.find_chords(chroma=np.array([chroma]),
+                                                                            lowest=np.array([lowest]))
+        if masks[0] == 0:
             return 'N', 'N', 'N', 0
         else:
-            candidates = self.sequencing(chroma=chroma)
-            scores, qualities = self.scoring(candidates=candidates)
-            # bass note
-            sorted_notes = []
-            for i, v in enumerate(np.sum(pianoroll, axis=0)):
-                if v > 0:
-                    sorted_notes.append(int(i % 12))
-            bass_note = sorted_notes[0]
-            # root note
-            __root_note = []
-            _max = max(scores.values())
-            for _root_note, score in scores.items():
-                if score == _max:
-                    __root_note.append(_root_note)
-            root_note = None
-            if len(__root_note) == 1:
-                root_note = __root_note[0]
-            else:
-                # TODO: what should i do
-                for n in sorted_notes:
-                    if n in __root_note:
-                        root_note = n
-                        break
-            # quality
-            quality = qualities.get(root_note)
-            # sequence = candidates.get(root_note)
-            # score
-            score = scores.get(root_note)
-            return self.PITCH_CLASSES[root_note], quality, self.PITCH_CLASSES[bass_note], score
+            return (self.PITCH_CLASSES[root_notes[0]], self.QUALITIES[qualities[0]], self.PITCH_CLASSES[bass_notes[0]],
+                    int(scores[0]))
+
+    def find_chord_from_mask(self, mask, lowest):
+        if mask == 0:
+            return 'N', 'N', 'N', 0
+        else:
+            scores, qualities, best_roots = self.chord_table
+            bass_note = min(range(12), key=lowest.__getitem__)
+            root_note = min(np.flatnonzero(best_roots[mask]).tolist(), key=lowest.__getitem__)
+            return (self.PITCH_CLASSES[root_note], self.QUALITIES[qualities[mask, root_note]],
+                    self.PITCH_CLASSES[bass_note], int(scores[mask, root_note]))
 
     @staticmethod
     def greedy(candidates, max_tick):
@@ -186,33 +258,97 @@ class MIDIChord(object):
         return temp2
 
     def extract(self, notes):
+        return self.extract_from_arrays(starts=np.array([n.start for n in notes], dtype=int),
+                                        ends=np.array([n.end for n in notes], dtype=int),
+                                        pitches=np.array([n.pitch for n in notes], dtype=int),
+                                        velocities=np.array([n.velocity for n in notes], dtype=int))
+
+    def extract_from_arrays(self, starts, ends, pitches, velocities):
+        if self.sparse:
+            return self.extract_sparse(starts, ends, pitches, velocities)
         # read
-        max_tick = max([n.end for n in notes])
+        max_tick = int(ends.max())
         ticks_per_beat = self.ticks_per_beat
-        pianoroll = self.note2pianoroll(
-            notes=notes,
-            max_tick=max_tick,
-            ticks_per_beat=ticks_per_beat)
+        chroma_prefix, lowest = self.beat_tables(
+            starts=starts,
+            ends=ends,
+            pitches=pitches,
+            velocities=velocities,
+            max_tick=max_tick)
+        n_beats = len(lowest)
         # get lots of candidates
         candidates = {}
+        beats = np.arange(n_beats)
         # beats to capture
         for interval in self.beats_to_capture:
-            for start_tick in range(0, max_tick, ticks_per_beat):
-                # set target pianoroll
-                end_tick = int(ticks_per_beat * interval + start_tick)
-                if end_tick > max_tick:
-                    end_tick = max_tick
-                _pianoroll = pianoroll[start_tick:end_tick, :]
-                # find chord
-                root_note, quality, bass_note, score = self.find_chord(pianoroll=_pianoroll)
+            # set target windows
+            start_ticks = beats * ticks_per_beat
+            end_ticks = np.minimum(start_ticks + ticks_per_beat * interval, max_tick)
+            chroma = chroma_prefix[np.minimum(beats + interval, n_beats)] - chroma_prefix[beats] > 0
+            # find chords
+            masks, root_notes, qualities, bass_notes, scores = self.find_chords(
+                chroma=chroma,
+                lowest=self.window_lowest(lowest, interval))
+            for start_tick, end_tick, mask, root_note, quality, bass_note, score in zip(
+                    start_ticks.tolist(), end_ticks.tolist(), masks.tolist(), root_notes.tolist(), qualities.tolist(),
+                    bass_notes.tolist(), scores.tolist()):
+                if mask:
+                    chord = (self.PITCH_CLASSES[root_note], self.QUALITIES[quality], self.PITCH_CLASSES[bass_note],
+                             score)
+                else:
+                    chord = ('N', 'N', 'N', 0)
                 # save
                 if start_tick not in candidates:
                     candidates[start_tick] = {}
-                    candidates[start_tick][end_tick] = (root_note, quality, bass_note, score)
+                    candidates[start_tick][end_tick] = chord
                 else:
                     if end_tick not in candidates[start_tick]:
-                        candidates[start_tick][end_tick] = (root_note, quality, bass_note, score)
+                        candidates[start_tick][end_tick] = chord
         # greedy
         chords = self.greedy(candidates=candidates,
                              max_tick=max_tick)
         return chords
+
+    def extract_sparse(self, starts, ends, pitches, velocities):
+        # read
+        max_tick = int(ends.max())
+        candidates = SparseCandidates(self, *self.note_segments(
+            starts=starts,
+            ends=ends,
+            pitches=pitches,
+            velocities=velocities,
+            max_tick=max_tick), max_tick=max_tick)
+        # greedy (candidates are found when visited)
+        chords = self.greedy(candidates=candidates,
+                             max_tick=max_tick)
+        return chords
+
+
+class SparseCandidates(object):
+    """ candidates of `MIDIChord.greedy` starting at a tick, from note segments of `MIDIChord.note_segments` """
+
+    def __init__(self, chord_method, segment_beats, masks, lowest, max_tick):
+        self.chord_method = chord_method
+        self.segment_beats = segment_beats
+        self.masks = masks
+        self.lowest = lowest
+        self.max_tick = max_tick
+        self.n_beats = -(-max_tick // chord_method.ticks_per_beat)
+
+    def find_chord(self, beat, interval):
+        first = bisect.bisect_right(self.segment_beats, beat) - 1
+        last = bisect.bisect_left(self.segment_beats, min(beat + interval, self.n_beats))
+        mask = 0
+        for m in self.masks[first:last]:
+            mask |= m
+        lowest = [min(pitches) for pitches in zip(*self.lowest[first:last])]
+        return self.chord_method.find_chord_from_mask(mask, lowest)
+
+    def get(self, start_tick):
+        ticks_per_beat = self.chord_method.ticks_per_beat
+        candidates = {}
+        for interval in self.chord_method.beats_to_capture:
+            end_tick = min(ticks_per_beat * interval + start_tick, self.max_tick)
+            if end_tick not in candidates:
+                candidates[end_tick] = self.find_chord(start_tick // ticks_per_beat, interval)
+        return candidates
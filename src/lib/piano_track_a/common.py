@@ -1,7 +1,63 @@
+import importlib
 import os
+import time
+
+
+class LazyModule(object):
+    """ module imported at first attribute access (heavy dependencies are not loaded until used) """
+
+    def __init__(self, name):
+        self.name = name
+        self.module = None
+
+    def __getattr__(self, attribute):
+        if self.module is None:
+            self.module = importlib.import_module(self.name)
+        return getattr(self.module, attribute)
+
+
+np = LazyModule('numpy')
+
+
+class Stats(object):
+    """
+    instrumentation of encoder/decoder (argument `stats`):
+        * `stages`: calls, wall time (seconds) and output size (items or tokens) of each stage;
+        * `counters`: dropped or unknown tokens (instead of warnings);
+        * `hook(name, seconds, size)`: called at the end of each stage if given;
+    """
+
+    def __init__(self, hook=None):
+        self.hook = hook
+        self.stages = {}
+        self.counters = {}
+
+    def record(self, name, seconds, size):
+        stage = self.stages.get(name)
+        if stage is None:
+            stage = self.stages[name] = {'calls': 0, 'time': 0.0, 'size': 0}
+        stage['calls'] += 1
+        stage['time'] += seconds
+        stage['size'] += int(size)
+        if self.hook is not None:
+            self.hook(name, seconds, size)
+
+    def count(self, name, n):
+        self.counters[name] = self.counters.get(name, 0) + int(n)
+
+    def reset(self):
+        self.stages = {}
+        self.counters = {}
+
+    def to_dict(self):
+        return {'stages': {name: dict(stage) for name, stage in self.stages.items()},
+                'counters': dict(self.counters)}
 
 
 class Common(object):
+    # `Stats` of encoder/decoder if instrumented (not a config)
+    stats = None
+
     def __init__(self):
         self.quantized_time = 0.02
         self.max_time_or_duration = 5
@@ -16,6 +72,31 @@ class Common(object):
         # calculate
         self.quantized_max_frame = int(self.max_time_or_duration / self.quantized_time)
 
+    def start_stage(self):
+        """ start time of a stage (`None` if not instrumented) """
+        if self.stats is None:
+            return None
+        return time.perf_counter()
+
+    def end_stage(self, name, start, size):
+        """ record wall time and output size (or function of it, not called if not instrumented) of a stage """
+        if start is not None:
+            self.stats.record(name, time.perf_counter() - start, size() if callable(size) else size)
+
+    def count(self, name, n):
+        """ count `n` tokens (such as dropped ones) if instrumented """
+        if self.stats is not None and n > 0:
+            self.stats.count(name, n)
+
+    def warn(self, name, n, message):
+        """ count `n` tokens if instrumented, otherwise print warning """
+        if n <= 0:
+            return
+        if self.stats is not None:
+            self.stats.count(name, n)
+        else:
+            print(f'WARNING: {message}')
+
 
 class Item(object):
     def __init__(self, name, time, velocity, pitch):
@@ -53,3 +134,116 @@ class Event(object):
 
     def __repr__(self):
         return f'Event(name={self.name}, time={self.time}, value={self.value}, text={self.text})'
+
+
+class TokenFamily(object):
+    def __init__(self, name, base, size, stride=1, start=None, labels=None):
+        self.name = name
+        self.base = base
+        self.size = size
+        self.stride = stride
+        # first value of integer family
+        self.start = start
+        # values of label family
+        self.labels = labels
+
+    def __repr__(self):
+        return f'TokenFamily(name={self.name}, base={self.base}, size={self.size}, stride={self.stride}, ' \
+               f'start={self.start}, labels={self.labels})'
+
+
+class TokenSpace(object):
+    """
+    Token ids of each family (`Name` or `Name~value` words) are evenly spaced by `stride`
+    (`1` if contiguous, `2` if built alternately with other family):
+    * integer family: `id = base + stride * (value - start)`;
+    * label family: `id = base + stride * labels.index(value)`;
+    * single word: `id = base`;
+    """
+
+    def __init__(self, w2i, separator):
+        self.separator = separator
+        self.size = len(w2i)
+        self.families = {}
+        # family code / value of each id (for classification)
+        self.id_codes = None
+        self.id_values = None
+        members = {}
+        for word, index in w2i.items():
+            name, _, value = word.partition(separator)
+            members.setdefault(name, []).append((index, value))
+        for name, family_members in members.items():
+            family_members.sort()
+            base = family_members[0][0]
+            stride = family_members[1][0] - base if len(family_members) > 1 else 1
+            if [index for index, _ in family_members] != list(range(base, base + stride * len(family_members),
+                                                                    stride)):
+                raise ValueError(f'ERROR: ids of `{name}` are not evenly spaced!')
+            values = [value for _, value in family_members]
+            start = labels = None
+            if values != ['']:
+                if all(value.isdigit() for value in values) and \
+                        [int(value) for value in values] == list(range(int(values[0]), int(values[0]) + len(values))):
+                    start = int(values[0])
+                else:
+                    labels = values
+            self.families[name] = TokenFamily(name, base, len(values), stride=stride, start=start, labels=labels)
+
+    @classmethod
+    def from_i2w(cls, i2w, separator):
+        return cls({word: index for index, word in i2w.items()}, separator)
+
+    def code(self, family):
+        """ index of family in `families` (`-1` if unknown) """
+        if family not in self.families:
+            return -1
+        return list(self.families).index(family)
+
+    def classification(self):
+        """ family code (`-1` if unknown) and value of each id, as lists (without `numpy`) """
+        length = max([family.base + family.stride * (family.size - 1) for family in self.families.values()]) + 1
+        id_codes = [-1] * length
+        id_values = [0] * length
+        for code, family in enumerate(self.families.values()):
+            for i in range(family.size):
+                id_codes[family.base + family.stride * i] = code
+                # value of integer family, or index of labels
+                id_values[family.base + family.stride * i] = i + (family.start or 0)
+        return id_codes, id_values
+
+    def build_classification(self):
+        id_codes, id_values = self.classification()
+        self.id_codes = np.array(id_codes)
+        self.id_values = np.array(id_values)
+
+    def classify(self, ids):
+        """ family codes (`-1` if unknown) and values of ids """
+        if self.id_codes is None:
+            self.build_classification()
+        ids = np.asarray(ids, dtype=int)
+        known = (ids >= 0) & (ids < len(self.id_codes))
+        codes = np.full(len(ids), -1)
+        codes[known] = self.id_codes[ids[known]]
+        values = np.zeros(len(ids), dtype=int)
+        values[known] = self.id_values[ids[known]]
+        return codes, values
+
+    def base(self, family):
+        """ id of single word family (`-1` if unknown) """
+        if family not in self.families:
+            return -1
+        return self.families[family].base
+
+    def ids(self, family, values):
+        """ ids of integer values or labels (`-1` if unknown or out of range) """
+        if family not in self.families:
+            return np.full(len(values), -1)
+        family = self.families[family]
+        if family.labels is not None:
+            offsets = {label: offset for offset, label in enumerate(family.labels)}
+            offsets = np.array([offsets.get(value, -1) for value in values], dtype=int)
+        elif family.start is not None:
+            offsets = np.asarray(values, dtype=int) - family.start
+        else:
+            offsets = np.zeros(len(values), dtype=int)
+        return np.where((offsets >= 0) & (offsets < family.size), family.base + family.stride * offsets, -1)
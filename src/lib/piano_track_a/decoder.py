@@ -1,19 +1,40 @@
+import copy
+import io
+import multiprocessing
+import numbers
 import os
-import sys
 
-import miditoolkit
+from .common import Common, Item, LazyModule, TokenSpace
 
-sys.path.append(os.path.dirname(os.path.abspath(__file__)))
-try:
-    from common import Common, Event
-except Exception:
-    raise ValueError('ERROR: cannot import!')
+# loaded at first use
+miditoolkit = LazyModule('miditoolkit')
+np = LazyModule('numpy')
+
+# decoder of each worker process (see `initialize_worker()`)
+worker = {}
+
+
+def initialize_worker(decoder):
+    # one decoder (and `i2w`) for each worker
+    worker['decoder'] = decoder
+
+
+def decode_sequence(task):
+    integers, output_path, output_format = task
+    # notes of a sequence do not wait for note-off of previous sequence
+    worker['decoder'].notes_status = [[0, 0]] * 127
+    return worker['decoder'].decode(integers, output_path=output_path, output_format=output_format)
 
 
 class MidiDecoder(Common):
-    def __init__(self, i2w, ticks_per_beat=480, decode_note=True, decode_control=True):
+    output_formats = ('midi', 'bytes', 'arrays')
+
+    def __init__(self, i2w, ticks_per_beat=480, decode_note=True, decode_control=True, stats=None):
         super().__init__()
         self.i2w = i2w
+        self.token_space = TokenSpace.from_i2w(i2w, self.separator)
+        # stage timers and token counters (`Stats`) if instrumented
+        self.stats = stats
 
         # other params
         self.default_ticks_per_beat = ticks_per_beat
@@ -26,84 +47,72 @@ class MidiDecoder(Common):
         # calculate
         self.quantized_tick_to_frame_scale = (ticks_per_beat * self.default_beat_per_minute / 60 * self.quantized_time)
 
-    def extract_events(self, events):
+    def extract_events(self, codes, values):
+        # family codes of tokens
+        note_on_pattern = [self.token_space.code(x) for x in ['NoteOn', 'Velocity']]
+        note_off = self.token_space.code('NoteOff')
+        paddle_on = self.token_space.code('PaddleOn')
+        paddle_off = self.token_space.code('PaddleOff')
+        delta_time = self.token_space.code('Time')
         # get downbeat and note (no time)
         temp_notes = []
         temp_controls = []
         accumulate_time = 0
+        dropped = 0
         i = 0
-        while i < len(events):
-            if i < len(events) - 1 and events[i].name == 'NoteOn' \
-                    and events[i + 1].name == 'Velocity':
+        while i < len(codes):
+            if i < len(codes) - 1 and codes[i:i + 2] == note_on_pattern:
                 # pitch
-                pitch = int(events[i].value)
+                pitch = values[i]
                 # velocity
-                velocity = int(events[i + 1].value)
+                velocity = values[i + 1]
                 # start/end time
                 time = int(round(accumulate_time))
                 # adding
                 temp_notes.append([pitch, velocity, time, True])
                 i += 2
-            elif i < len(events) and events[i].name == 'NoteOff':
+            elif codes[i] == note_off:
                 # pitch
-                pitch = int(events[i].value)
+                pitch = values[i]
                 # start/end time
                 time = int(round(accumulate_time))
                 # adding
                 temp_notes.append([pitch, None, time, False])
                 i += 1
-            elif i < len(events) and events[i].name == 'PaddleOn':
+            elif codes[i] == paddle_on:
                 # control
-                control = int(events[i].value)
+                control = values[i]
                 # start/end time
                 time = int(round(accumulate_time))
                 # adding
                 temp_controls.append([control, time, True])
                 i += 1
-            elif i < len(events) and events[i].name == 'PaddleOff':
+            elif codes[i] == paddle_off:
                 # control
-                control = int(events[i].value)
+                control = values[i]
                 # start/end time
                 time = int(round(accumulate_time))
                 # adding
                 temp_controls.append([control, time, False])
                 i += 1
-            elif events[i].name == 'Time':
+            elif codes[i] == delta_time:
                 # delta time
-                delta_time = events[i].value * self.quantized_tick_to_frame_scale
-                accumulate_time += delta_time
+                accumulate_time += values[i] * self.quantized_tick_to_frame_scale
                 i += 1
             else:
                 # bad case incrementation
+                dropped += 1
                 i += 1
+        self.count('dropped_tokens', dropped)
         return temp_notes, temp_controls
 
-    @staticmethod
-    def to_int(string):
-        # noinspection PyBroadException
-        try:
-            return int(string)
-        except Exception:
-            return string
-
-    def words_to_events(self, words):
-        events = []
-        for word in words:
-            word_split = word.split(self.separator)
-            if self.separator not in word:
-                events.append(Event(name=word_split[0], time=None, value=None, text=None))
-            else:
-                events.append(Event(name=word_split[0], time=None, value=self.to_int(word_split[1]), text=None))
-        return events
-
-    def integers_to_words(self, integers):
-        words = []
-        for integer in integers:
-            if integer in self.i2w:
-                words.append(self.i2w[integer])
-            else:
-                print(f'WARNING: `{integer}` not in i2w!')
-        return words
+    def integers_to_tokens(self, integers):
+        """ family codes and values of integers (unknown integers dropped) """
+        codes, values = self.token_space.classify(integers)
+        known = codes >= 0
+        n_unknown = len(known) - int(np.count_nonzero(known))
+        self.warn('unknown_integers', n_unknown, f'{n_unknown} integers not in i2w!')
+        return codes[known].tolist(), values[known].tolist()
 
     def build_notes(self, temp_notes):
         notes_list = []
@@ -139,19 +148,27 @@ class MidiDecoder(Common):
                 controls_list.append(miditoolkit.ControlChange(number=control, value=0, time=time))
         return controls_list
 
-    def decode(self, integers, output_path):
-        # decode to events
-        words = self.integers_to_words(integers)
-        events = self.words_to_events(words)
+    def build_midi(self, integers):
+        """ `miditoolkit` midi object of integers """
+        # decode to family codes and values
+        start = self.start_stage()
+        codes, values = self.integers_to_tokens(integers)
+        self.end_stage('integers_to_tokens', start, len(codes))
 
         # decode properties
-        temp_notes, temp_controls = self.extract_events(events)
+        start = self.start_stage()
+        temp_notes, temp_controls = self.extract_events(codes, values)
+        self.end_stage('extract_events', start, len(temp_notes) + len(temp_controls))
 
         # get specific time for items
         # notes
+        start = self.start_stage()
         notes = self.build_notes(temp_notes)
+        self.end_stage('build_notes', start, len(notes))
         # controls
+        start = self.start_stage()
         controls = self.build_controls(temp_controls)
+        self.end_stage('build_controls', start, len(controls))
 
         # write MIDI
         midi = miditoolkit.midi.parser.MidiFile(ticks_per_beat=self.default_ticks_per_beat)
@@ -165,5 +182,172 @@ class MidiDecoder(Common):
             inst.control_changes = controls
         midi.instruments.append(inst)
 
-        # export MIDI
-        midi.dump(output_path)
+        return midi
+
+    def decode(self, integers, output_path=None, output_format='midi'):
+        """
+        decode integers to `output_format`, and export midi file to `output_path` if given:
+            * `midi`: `miditoolkit` midi object;
+            * `bytes`: standard midi file bytes;
+            * `arrays`: arrays of notes, controls and tempos as `MidiCache.midi_to_arrays()` (no markers);
+        """
+        if output_format not in self.output_formats:
+            raise ValueError(f'ERROR: output format `{output_format}` not supported!')
+        midi = self.build_midi(integers)
+        if output_path is not None or output_format == 'bytes':
+            # export MIDI
+            start = self.start_stage()
+            file = io.BytesIO()
+            midi.dump(file=file)
+            data = file.getvalue()
+            self.end_stage('dump', start, len(data))
+            if output_path is not None:
+                with open(output_path, 'wb') as f:
+                    f.write(data)
+            if output_format == 'bytes':
+                return data
+        if output_format == 'arrays':
+            from ..midi_cache import MidiCache
+            return MidiCache.midi_to_arrays(midi)
+        return midi
+
+    @staticmethod
+    def unpad(sequences, lengths=None, pad=None):
+        """ sequences (list of arrays, or rows of padded 2D array) cut by `lengths` and at first `pad` (pad/eos id) """
+        sequences = [np.asarray(sequence) for sequence in sequences]
+        if lengths is not None:
+            if len(lengths) != len(sequences):
+                raise ValueError('ERROR: numbers of sequences and lengths are different!')
+            sequences = [sequence[:length] for sequence, length in zip(sequences, lengths)]
+        if pad is not None:
+            sequences = [sequence[:np.argmax(sequence == pad)] if np.any(sequence == pad) else sequence
+                         for sequence in sequences]
+        return sequences
+
+    def decode_batch(self, sequences, lengths=None, pad=None, output_paths=None, output_format='midi', cpu_number=1,
+                     chunk_size=4):
+        """ `decode()` results of sequences in order, decoded by `cpu_number` processes (all cpus if `0`) """
+        if output_format not in self.output_formats:
+            raise ValueError(f'ERROR: output format `{output_format}` not supported!')
+        sequences = self.unpad(sequences, lengths=lengths, pad=pad)
+        if output_paths is None:
+            output_paths = [None] * len(sequences)
+        elif len(output_paths) != len(sequences):
+            raise ValueError('ERROR: numbers of sequences and output paths are different!')
+        tasks = [(sequence, output_path, output_format) for sequence, output_path in zip(sequences, output_paths)]
+        cpu_number = min(cpu_number if cpu_number > 0 else os.cpu_count(), len(tasks))
+        if cpu_number <= 1:
+            # as workers, notes of a sequence do not wait for note-off of previous sequence (`notes_status` of a copy)
+            decoder = copy.copy(self)
+            results = []
+            for integers, output_path, output_format in tasks:
+                decoder.notes_status = [[0, 0]] * 127
+                results.append(decoder.decode(integers, output_path=output_path, output_format=output_format))
+            return results
+        # stats (and its hook) are not sent to workers
+        decoder = copy.copy(self)
+        decoder.stats = None
+        with multiprocessing.Pool(cpu_number, initializer=initialize_worker, initargs=(decoder,)) as pool:
+            return pool.map(decode_sequence, tasks, chunksize=chunk_size)
+
+
+class MidiStreamDecoder(object):
+    """
+    incremental decoder of integers (for generation), same notes and controls as `MidiDecoder.decode()`:
+        * `feed()` integers one by one or in chunks, returns items completed by them;
+        * a note is `NoteOn`/`NoteOff` items returned at its note-off (or next note-on of its pitch);
+        * tokens of an unfinished pattern wait in `buffer` (at most one pattern).
+    """
+
+    def __init__(self, decoder):
+        self.decoder = decoder
+        token_space = decoder.token_space
+        self.id_codes, self.id_values = token_space.classification()
+        # (family codes, item builder) in order of `MidiDecoder.extract_events()`
+        self.rules = [([token_space.code(x) for x in ['NoteOn', 'Velocity']], self.note_on),
+                      ([token_space.code('NoteOff')], self.note_off),
+                      ([token_space.code('PaddleOn')], self.paddle_on),
+                      ([token_space.code('PaddleOff')], self.paddle_off),
+                      ([token_space.code('Time')], self.delta_time)]
+        # tokens waiting, time of consumed tokens, (velocity, time) of note-on
+        self.buffer = []
+        self.accumulate_time = 0
+        self.notes_status = [[0, 0]] * 128
+
+    def reset(self):
+        self.buffer = []
+        self.accumulate_time = 0
+        self.notes_status = [[0, 0]] * 128
+
+    def feed(self, integers):
+        """ items completed by an integer or integers """
+        if isinstance(integers, numbers.Integral):
+            integers = [integers]
+        items = []
+        n_unknown = 0
+        for integer in integers:
+            integer = int(integer)
+            if integer < 0 or integer >= len(self.id_codes) or self.id_codes[integer] < 0:
+                n_unknown += 1
+                continue
+            self.buffer.append((self.id_codes[integer], self.id_values[integer]))
+            # consume complete patterns (or bad tokens) at buffer head
+            while len(self.buffer) > 0:
+                consumed = self.match(items)
+                if consumed == 0:
+                    break
+                del self.buffer[:consumed]
+        self.decoder.warn('unknown_integers', n_unknown, f'{n_unknown} integers not in i2w!')
+        return items
+
+    def match(self, items):
+        """ number of tokens consumed at buffer head (`0` if waiting for tokens) """
+        for pattern, build in self.rules:
+            n = min(len(pattern), len(self.buffer))
+            if all(self.buffer[j][0] == pattern[j] for j in range(n)):
+                if n < len(pattern):
+                    return 0
+                items.extend(build([value for _, value in self.buffer[:len(pattern)]]))
+                return len(pattern)
+        # bad case
+        self.decoder.count('dropped_tokens', 1)
+        return 1
+
+    def time(self):
+        return int(round(self.accumulate_time))
+
+    def note_on(self, values):
+        pitch, velocity = values
+        on_velocity, on_time = self.notes_status[pitch]
+        self.notes_status[pitch] = [velocity, self.time()]
+        if on_velocity == 0:
+            return []
+        # bad multiple note-on will translate notes
+        return self.build_note(pitch, on_velocity, on_time)
+
+    def note_off(self, values):
+        pitch, = values
+        on_velocity, on_time = self.notes_status[pitch]
+        # reset
+        self.notes_status[pitch] = [0, 0]
+        return self.build_note(pitch, on_velocity, on_time)
+
+    def build_note(self, pitch, on_velocity, on_time):
+        if not self.decoder.decode_note:
+            return []
+        return [Item(name='NoteOn', time=on_time, velocity=on_velocity, pitch=pitch),
+                Item(name='NoteOff', time=self.time(), velocity=on_velocity, pitch=pitch)]
+
+    def paddle_on(self, values):
+        if not self.decoder.decode_control:
+            return []
+        return [Item(name='PaddleOn', time=self.time(), velocity=None, pitch=values[0])]
+
+    def paddle_off(self, values):
+        if not self.decoder.decode_control:
+            return []
+        return [Item(name='PaddleOff', time=self.time(), velocity=None, pitch=values[0])]
+
+    def delta_time(self, values):
+        self.accumulate_time += values[0] * self.decoder.quantized_tick_to_frame_scale
+        return []
@@ -1,25 +1,26 @@
-import os
 import random
-import sys
 
 import miditoolkit
 import numpy as np
 
-sys.path.append(os.path.dirname(os.path.abspath(__file__)))
-try:
-    from common import Common, Item, Event
-except Exception:
-    raise ValueError('ERROR: cannot import!')
+from .common import Common, Item, Event, TokenSpace
 
 
 class MidiEncoder(Common):
     def __init__(self, file_path, w2i, pitch_variation_range=None,
                  velocity_scale_variation_range=None,
                  velocity_noise_scale_variation_range=None,
-                 tempo_scale_variation_range=None):
+                 tempo_scale_variation_range=None,
+                 fast=False,
+                 midi_cache=None,
+                 stats=None):
         super().__init__()
         self.file_path = file_path
         self.w2i = w2i
+        self.fast = fast
+        # parsed midi cache (`MidiCache`) if any, and arrays of midi file loaded from it
+        self.midi_cache = midi_cache
+        self.midi_arrays = None
         self.pitch_variation_range = pitch_variation_range
         self.velocity_scale_variation_range = velocity_scale_variation_range
         self.velocity_noise_scale_variation_range = velocity_noise_scale_variation_range
@@ -30,51 +31,91 @@ class MidiEncoder(Common):
         self.controls = []
         self.ticks_per_beat = None
         self.quantized_tick_to_frame_scale = None
+        # token id arithmetic (struct-of-arrays engine)
+        self.token_space = None
+        self.unknown_tokens = 0
+        # parsed columns of midi file (struct-of-arrays engine, shared by variations)
+        self.base_arrays = None
         # variation
         self.pitch_variation = None
         self.velocity_variation = None
         self.tempo_variation = None
+        # random generator of variation (`random` module, or `random.Random` of `encode_variations()`)
+        self.rng = random
+        # stage timers and token counters (`Stats`) if instrumented
+        self.stats = stats
 
         # initialization
+        start = self.start_stage()
         self.initialize_midi(self.file_path)
+        self.end_stage('initialize_midi', start, self.midi_size)
 
     def initialize_midi(self, path):
-        # read midi now
-        midi_obj = miditoolkit.midi.parser.MidiFile(path)
+        # read midi now (through cache if any)
+        if self.midi_cache is None:
+            midi_obj = miditoolkit.midi.parser.MidiFile(path)
+            self.read_instruments(midi_obj.instruments)
+        else:
+            # notes and controls are read from cached arrays by `parse_arrays()`, objects are built for item engine
+            self.midi_arrays = self.midi_cache.load_arrays(path)
+            midi_obj = self.midi_cache.arrays_to_midi(self.midi_arrays, with_instruments=False)
+            self.notes = None
+            self.controls = None
         self.ticks_per_beat = midi_obj.ticks_per_beat
+        # assume default `bpm` is 120
+        self.quantized_tick_to_frame_scale = (
+                self.ticks_per_beat * self.default_beat_per_minute / 60 * self.quantized_time)
+
+    def read_instruments(self, instruments):
         # assume all channel notes and controls are piano_track
-        for instrument in midi_obj.instruments:
+        for instrument in instruments:
             self.notes.extend(instrument.notes)
             for control in instrument.control_changes:
                 if 64 <= control.number <= 69:
                     self.controls.append(control)
-        # assume default `bpm` is 120
-        self.quantized_tick_to_frame_scale = (
-                self.ticks_per_beat * self.default_beat_per_minute / 60 * self.quantized_time)
+
+    def load_notes(self):
+        """ note and control objects of midi file (built from cached arrays at first use) """
+        if self.notes is None:
+            self.notes = []
+            self.controls = []
+            self.read_instruments(self.midi_cache.arrays_to_midi(self.midi_arrays).instruments)
+
+    def midi_size(self):
+        """ number of notes and paddle controls of midi file """
+        if self.notes is None:
+            return len(self.midi_arrays['notes']) + len(self.control_rows())
+        return len(self.notes) + len(self.controls)
+
+    def control_rows(self):
+        """ (number, value, time) of paddle controls, from cached arrays if not read as objects """
+        if self.controls is None:
+            controls = self.midi_arrays['controls']
+            return controls[(controls[:, 0] >= 64) & (controls[:, 0] <= 69)].tolist()
+        return [(control.number, control.value, control.time) for control in self.controls]
 
     def initialize_variation(self, variation):
         if variation and self.pitch_variation_range is not None:
-            self.pitch_variation = random.randint(self.pitch_variation_range[0],
-                                                  self.pitch_variation_range[1])
+            self.pitch_variation = self.rng.randint(self.pitch_variation_range[0],
+                                                    self.pitch_variation_range[1])
         else:
             self.pitch_variation = 0
         if variation and self.velocity_scale_variation_range is not None:
-            self.velocity_variation = random.uniform(self.velocity_scale_variation_range[0],
-                                                     self.velocity_scale_variation_range[1])
+            self.velocity_variation = self.rng.uniform(self.velocity_scale_variation_range[0],
+                                                       self.velocity_scale_variation_range[1])
         else:
             self.velocity_variation = 1
         if variation and self.tempo_scale_variation_range is not None:
-            self.tempo_variation = random.uniform(self.tempo_scale_variation_range[0],
-                                                  self.tempo_scale_variation_range[1])
+            self.tempo_variation = self.rng.uniform(self.tempo_scale_variation_range[0],
+                                                    self.tempo_scale_variation_range[1])
         else:
             self.tempo_variation = 1
 
-    @staticmethod
-    def velocity_transform(velocity, scale):
+    def velocity_transform(self, velocity, scale):
         if scale > 0:
             velocity = min(int(round(scale * velocity)), 127)
         elif scale < 0:
-            diff = random.uniform(0, scale * 127)
+            diff = self.rng.uniform(0, scale * 127)
             velocity = int(round(scale * velocity + diff))
         return velocity
 
@@ -83,13 +124,53 @@ class MidiEncoder(Common):
             return velocity
         else:
             # add dynamic noise
-            noise_scale = random.uniform(self.velocity_noise_scale_variation_range[0],
-                                         self.velocity_noise_scale_variation_range[0])
+            noise_scale = self.rng.uniform(self.velocity_noise_scale_variation_range[0],
+                                           self.velocity_noise_scale_variation_range[0])
             return self.velocity_transform(velocity, noise_scale)
 
     def tempo_transform(self, tempo):
         return int(tempo * self.tempo_variation)
 
+    def velocity_array_transform(self, velocities, scales):
+        scales = np.broadcast_to(scales, np.shape(velocities))
+        scaled = np.minimum(np.round(scales * velocities).astype(int), 127)
+        negative = scales < 0
+        if np.any(negative):
+            # random shift of each velocity of negative scale (drawn in order as `velocity_transform()`)
+            diffs = np.array([self.rng.uniform(0, scale * 127) for scale in scales[negative].tolist()])
+            scaled[negative] = np.round(scales[negative] * velocities[negative] + diffs).astype(int)
+        return np.where(scales != 0, scaled, velocities)
+
+    def velocity_noise_array_add(self, velocities):
+        if self.velocity_noise_scale_variation_range is None:
+            return velocities
+        else:
+            # add dynamic noise
+            noise_scales = np.array([self.rng.uniform(self.velocity_noise_scale_variation_range[0],
+                                                      self.velocity_noise_scale_variation_range[0])
+                                     for _ in range(len(velocities))])
+            return self.velocity_array_transform(velocities, noise_scales)
+
+    def velocity_array_variation(self, velocities):
+        """ `velocity_transform()` then `velocity_noise_add()` of velocities, same random draws as item engine """
+        noise_range = self.velocity_noise_scale_variation_range
+        if noise_range is not None and (self.velocity_variation < 0 or min(noise_range) < 0):
+            # random shifts and noise scales are drawn alternately for each velocity
+            return np.array([self.velocity_noise_add(self.velocity_transform(velocity, self.velocity_variation))
+                             for velocity in velocities.tolist()], dtype=int).reshape(-1)
+        velocities = self.velocity_array_transform(velocities, self.velocity_variation)
+        return self.velocity_noise_array_add(velocities)
+
+    def tempo_array_transform(self, ticks):
+        return (ticks * self.tempo_variation).astype(int)
+
+    def pitch_array_transform(self, pitches):
+        target_pitches = pitches + self.pitch_variation
+        # fold into range by octaves
+        target_pitches = np.where(target_pitches > 127, target_pitches - (target_pitches - 116) // 12 * 12,
+                                  target_pitches)
+        return np.where(target_pitches < 0, target_pitches + (11 - target_pitches) // 12 * 12, target_pitches)
+
     def pitch_transform(self, pitch):
         target_pitch = pitch + self.pitch_variation
         if target_pitch > 127:
@@ -101,6 +182,7 @@ class MidiEncoder(Common):
         return target_pitch
 
     def read_items(self):
+        self.load_notes()
         # notes
         note_items = []
         for note in self.notes:
@@ -124,34 +206,40 @@ class MidiEncoder(Common):
 
         # control
         control_items = []
+        for number, start, end in self.read_paddles():
+            start_time = self.tempo_transform(start)
+            end_time = self.tempo_transform(end)
+            # paddle object should larger than `1` frame
+            if end_time - start_time >= self.quantized_tick_to_frame_scale:
+                control_items.append(Item(
+                    name='PaddleOn',
+                    time=start_time,
+                    velocity=None,
+                    pitch=number))
+                control_items.append(Item(
+                    name='PaddleOff',
+                    time=end_time,
+                    velocity=None,
+                    pitch=number))
+        return note_items, control_items
+
+    def read_paddles(self):
+        """ paddle (number, on tick, off tick) from controls """
+        paddles = []
         status = [False] * 127
         start = [0] * 127
         value = [0] * 127
-        for control in self.controls:
-            number = control.number
-            value[number] = control.value
+        for number, control_value, time in self.control_rows():
+            value[number] = control_value
             if value[number] > 0:
                 if not status[number]:
-                    start[number] = control.time
+                    start[number] = time
                 status[number] = True
             else:
                 if status[number]:
-                    start_time = self.tempo_transform(start[number])
-                    end_time = self.tempo_transform(control.time)
-                    # paddle object should larger than `1` frame
-                    if end_time - start_time >= self.quantized_tick_to_frame_scale:
-                        control_items.append(Item(
-                            name='PaddleOn',
-                            time=start_time,
-                            velocity=None,
-                            pitch=number))
-                        control_items.append(Item(
-                            name='PaddleOff',
-                            time=end_time,
-                            velocity=None,
-                            pitch=number))
+                    paddles.append((number, start[number], time))
                 status[number] = False
-        return note_items, control_items
+        return paddles
 
     def quantize_items(self, items):
         """ convert to quantized `bigger` frames """
@@ -162,7 +250,7 @@ class MidiEncoder(Common):
         return items
 
     def time_or_duration_transform(self, duration):
-        return min(self.quantized_max_frame, max(1, duration))
+        return np.minimum(self.quantized_max_frame, np.maximum(1, duration))
 
     def item_to_event(self, items):
         events = []
@@ -225,22 +313,161 @@ class MidiEncoder(Common):
             if word in self.w2i:
                 integers.append(self.w2i[word])
             else:
-                print(f'WARNING: `{word}` not in w2i!')
+                self.unknown_tokens += 1
         return integers
 
-    def encode(self, variation=True):
+    def count_unknown(self, ids):
+        self.unknown_tokens += int(np.sum(ids < 0))
+        return ids
+
+    def token_ids(self, family, values):
+        """ `base + value` of family (unknown or out of range counted) """
+        return self.count_unknown(self.token_space.ids(family, values))
+
+    def warn_unknown_tokens(self):
+        self.warn('unknown_tokens', self.unknown_tokens, f'{self.unknown_tokens} tokens not in w2i!')
+
+    def parse_arrays(self):
+        """ note columns and paddles of midi file, parsed once """
+        if self.base_arrays is None and self.notes is None:
+            # columns of cached arrays (note rows: start, end, pitch, velocity)
+            notes = np.asarray(self.midi_arrays['notes'], dtype=int)
+            self.base_arrays = {'start': notes[:, 0],
+                                'end': notes[:, 1],
+                                'pitch': notes[:, 2],
+                                'velocity': notes[:, 3],
+                                'paddle': np.array(self.read_paddles(), dtype=int).reshape(-1, 3)}
+        if self.base_arrays is None:
+            self.base_arrays = {'start': np.array([note.start for note in self.notes], dtype=int),
+                                'end': np.array([note.end for note in self.notes], dtype=int),
+                                'pitch': np.array([note.pitch for note in self.notes], dtype=int),
+                                'velocity': np.array([note.velocity for note in self.notes], dtype=int),
+                                'paddle': np.array(self.read_paddles(), dtype=int).reshape(-1, 3)}
+        return self.base_arrays
+
+    def read_arrays(self):
+        """ struct-of-arrays counterpart of `read_items()` """
+        base_table = self.parse_arrays()
+        # notes (note-on / note-off alternately)
+        velocities = self.velocity_array_variation(base_table['velocity'])
+        start_times = self.tempo_array_transform(base_table['start'])
+        end_times = self.tempo_array_transform(base_table['end'])
+        # duration should larger than `1` frame
+        end_times = np.where(end_times - start_times < self.quantized_tick_to_frame_scale,
+                             start_times + self.quantized_tick_to_frame_scale, end_times)
+        pitches = self.pitch_array_transform(base_table['pitch'])
+        note_table = {'kind': np.tile([0, 1], len(base_table['start'])),
+                      'time': np.column_stack([start_times, end_times]).ravel(),
+                      'pitch': np.repeat(pitches, 2),
+                      'velocity': np.repeat(velocities, 2)}
+
+        # control (paddle-on / paddle-off alternately)
+        paddles = base_table['paddle']
+        start_times = self.tempo_array_transform(paddles[:, 1])
+        end_times = self.tempo_array_transform(paddles[:, 2])
+        # paddle object should larger than `1` frame
+        keep = end_times - start_times >= self.quantized_tick_to_frame_scale
+        control_table = {'kind': np.tile([2, 3], np.sum(keep)),
+                         'time': np.column_stack([start_times[keep], end_times[keep]]).ravel(),
+                         'pitch': np.repeat(paddles[keep, 0], 2),
+                         'velocity': np.zeros(2 * np.sum(keep), dtype=int)}
+        return note_table, control_table
+
+    def quantize_arrays(self, table):
+        """ convert to quantized `bigger` frames """
+        table['time'] = np.round(table['time'] / self.quantized_tick_to_frame_scale).astype(int)
+        return table
+
+    def arrays_to_integers(self, tables):
+        """ item tokens as rows: `Time` (if changed), then item event """
+        combined = {column: np.concatenate([table[column] for table in tables]).astype(int)
+                    for column in ['kind', 'time', 'pitch', 'velocity']}
+        order = np.argsort(combined['time'], kind='stable')
+        kinds, times, pitches = combined['kind'][order], combined['time'][order], combined['pitch'][order]
+        rows = np.full((len(kinds), 3), -1)
+        delta_times = np.diff(times)
+        changed = np.flatnonzero(delta_times) + 1
+        rows[changed, 0] = self.token_ids('Time', self.time_or_duration_transform(delta_times[changed - 1]))
+        for kind, name in enumerate(['NoteOn', 'NoteOff', 'PaddleOn', 'PaddleOff']):
+            mask = kinds == kind
+            rows[mask, 1] = self.token_ids(name, pitches[mask])
+        mask = kinds == 0
+        rows[mask, 2] = self.token_ids('Velocity', combined['velocity'][order][mask])
+        return rows[rows >= 0]
+
+    def encode_fast(self, variation=True):
+        """ struct-of-arrays engine, same integers as `encode_items()` without `Item`/`Event` objects """
+        if self.token_space is None:
+            self.token_space = TokenSpace(self.w2i, self.separator)
+        self.unknown_tokens = 0
         self.initialize_variation(variation)
+        start = self.start_stage()
+        note_table, control_table = self.read_arrays()
+        self.end_stage('read_arrays', start, len(note_table['kind']) + len(control_table['kind']))
+        start = self.start_stage()
+        note_table = self.quantize_arrays(note_table)
+        control_table = self.quantize_arrays(control_table)
+        self.end_stage('quantize_arrays', start, len(note_table['kind']) + len(control_table['kind']))
+        tables = []
+        if self.with_note:
+            tables.append(note_table)
+        if self.with_control:
+            tables.append(control_table)
+        start = self.start_stage()
+        ints = self.arrays_to_integers(tables)
+        self.end_stage('arrays_to_integers', start, len(ints))
+        self.warn_unknown_tokens()
+        return ints
+
+    def encode_items(self, variation=True):
+        self.unknown_tokens = 0
+        self.initialize_variation(variation)
+        start = self.start_stage()
         note_items, control_items = self.read_items()
+        self.end_stage('read_items', start, len(note_items) + len(control_items))
+        start = self.start_stage()
         note_items = self.quantize_items(note_items)
         control_items = self.quantize_items(control_items)
+        self.end_stage('quantize_items', start, len(note_items) + len(control_items))
+        start = self.start_stage()
         all_items = []
         if self.with_note:
             all_items.extend(note_items)
         if self.with_control:
             all_items.extend(control_items)
         all_items.sort(key=lambda x: x.time)
+        self.end_stage('group_items', start, len(all_items))
+        start = self.start_stage()
         events = self.item_to_event(all_items)
+        self.end_stage('item_to_event', start, len(events))
+        start = self.start_stage()
         words = self.events_to_words(events)
+        self.end_stage('events_to_words', start, len(words))
+        start = self.start_stage()
         ints = self.words_to_integers(words)
+        self.end_stage('words_to_integers', start, len(ints))
+        self.warn_unknown_tokens()
         ints = np.array(ints)
         return ints
+
+    def encode(self, variation=True):
+        if self.fast:
+            return self.encode_fast(variation)
+        return self.encode_items(variation)
+
+    def encode_variations(self, k, seed=None):
+        """ `k` variations by struct-of-arrays engine on one parse of midi file (`seed` for own random generator) """
+        rng = self.rng
+        if seed is not None:
+            self.rng = random.Random(seed)
+        try:
+            return [self.encode_fast(variation=True) for _ in range(k)]
+        finally:
+            self.rng = rng
+
+    def cross_check(self, variation=True):
+        """ check `encode_fast()` against `encode_items()` under same random state """
+        state = self.rng.getstate()
+        ints = self.encode_items(variation)
+        self.rng.setstate(state)
+        return np.array_equal(ints, self.encode_fast(variation))
@@ -1,24 +1,37 @@
+import hashlib
 import os
 import pickle
-import sys
+import uuid
 
-sys.path.append(os.path.dirname(os.path.abspath(__file__)))
-try:
-    from common import Common, Event
-except Exception:
-    raise ValueError('ERROR: cannot import!')
+from .common import Common, Event, TokenSpace
+
+# (`w2i`, `i2w`, token space) built in this process, keyed by config fingerprint
+vocabularies = {}
 
 
 class EventDict(Common):
     def __init__(self):
         super().__init__()
+        # (all attributes above are config)
+        self.fingerprint = self.config_fingerprint()
 
         self.global_counter = 0
         self.w2i = {}
         self.i2w = {}
+        self.token_space = None
+
+        # calculate (once for each config in process)
+        if self.fingerprint not in vocabularies:
+            self.build_all()
+            vocabularies[self.fingerprint] = (self.w2i, self.i2w, TokenSpace(self.w2i, self.separator))
+        self.w2i, self.i2w, self.token_space = vocabularies[self.fingerprint]
+        self.global_counter = len(self.w2i)
 
-        # calculate
-        self.build_all()
+    def config_fingerprint(self):
+        """ hash of package and config attributes, which the vocabulary derives from """
+        config = sorted((name, value) for name, value in vars(self).items() if name != 'dic_path')
+        package = os.path.basename(os.path.dirname(os.path.abspath(__file__)))
+        return hashlib.sha1(repr([package, config]).encode()).hexdigest()
 
     def update(self, word):
         self.w2i[word] = self.global_counter
@@ -52,14 +65,23 @@ class EventDict(Common):
             self.build_velocity()
         self.build_delta_time()
 
-    def export(self):
-        result = [self.w2i, self.i2w]
-        with open(self.dic_path, 'wb') as w:
-            pickle.dump(result, w)
+    def export(self, path=None):
+        """ write vocabulary and config fingerprint to `path` (`dic_path` if not given) atomically """
+        path = self.dic_path if path is None else path
+        temp_path = f'{path}.{uuid.uuid4().hex}.tmp'
+        with open(temp_path, 'wb') as w:
+            pickle.dump({'fingerprint': self.fingerprint, 'w2i': self.w2i, 'i2w': self.i2w}, w)
+        os.replace(temp_path, path)
+
+    def load_dict(self, path=None):
+        """ `w2i` and `i2w` of exported file, which must be built from current config """
+        path = self.dic_path if path is None else path
+        with open(path, 'rb') as f:
+            result = pickle.load(f)
+        if not isinstance(result, dict) or result.get('fingerprint') != self.fingerprint:
+            raise ValueError(f'ERROR: [{path}] is not built from current config!')
+        return result['w2i'], result['i2w']
 
     def check_and_load_dict(self):
-        if not os.path.exists(self.dic_path):
-            self.export()
-        with open(self.dic_path, 'rb') as f:
-            w2i, i2w = pickle.load(f)
-        return w2i, i2w
+        """ `w2i` and `i2w` of current config (built in memory, no file) """
+        return self.w2i, self.i2w
@@ -2,6 +2,7 @@ import argparse
 import os
 
 import miditoolkit
+import numpy as np
 
 # https://github.com/RobertBoganKang/file_processing
 from file_processing import FileProcessing
@@ -14,9 +15,10 @@ class RemoveTempoSingle(object):
         self.default_beat_per_minute = 120
         self.default_ticks_per_beat = ticks_per_beat
 
-        # system param
-        self.tick_delta_time = []
-        self.accumulated_tick_time = []
+        # system param (piecewise-linear map of ticks, see `build_tempo_ticks()`)
+        self.segment_ticks = None
+        self.segment_new_ticks = None
+        self.segment_scales = None
         self.ticks_per_beat = None
         self.max_tick = None
         self.tempos = None
@@ -36,6 +38,7 @@ class RemoveTempoSingle(object):
         self.instruments = midi_obj.instruments
 
     def build_tempo_ticks(self):
+        """ tempo segments: start ticks, their new ticks, and new ticks per tick (memory of tempo changes only) """
         tempo_timestamp = []
         for tempo_obj in self.tempos:
             tempo = tempo_obj.tempo
@@ -44,20 +47,21 @@ class RemoveTempoSingle(object):
         tempo_timestamp.sort(key=lambda x: x[0])
         if len(tempo_timestamp) == 0 or tempo_timestamp[0][0] != 0:
             tempo_timestamp = [[0, self.default_beat_per_minute]] + tempo_timestamp
-        tempo_timestamp = tempo_timestamp + [[self.max_tick, self.default_beat_per_minute]]
-        # calculate accumulate tick
-        for i in range(len(tempo_timestamp) - 1):
-            delta_time = tempo_timestamp[i + 1][0] - tempo_timestamp[i][0]
-            tempo = tempo_timestamp[i][1]
-            for _ in range(delta_time):
-                scaled_tick = (self.tempo_scale *
-                               self.default_beat_per_minute / tempo
+        times = np.array([time for time, _ in tempo_timestamp], dtype=np.int64)
+        tempos = np.array([tempo for _, tempo in tempo_timestamp], dtype=float)
+        self.segment_ticks = times
+        self.segment_scales = (self.tempo_scale * self.default_beat_per_minute / tempos
                                / self.ticks_per_beat * self.default_ticks_per_beat)
-                self.tick_delta_time.append(scaled_tick)
-        accumulate = 0
-        for st in self.tick_delta_time:
-            self.accumulated_tick_time.append(int(round(accumulate)))
-            accumulate += st
+        # calculate accumulate tick at start of segments (empty segments of same time are skipped)
+        self.segment_new_ticks = np.concatenate([[0.0], np.cumsum(np.diff(times) * self.segment_scales[:-1])])
+
+    def map_ticks(self, ticks):
+        """ new ticks of ticks (the last tempo segment lasts to the end) """
+        ticks = np.asarray(ticks, dtype=np.int64)
+        # the last tempo of the same time wins
+        index = np.searchsorted(self.segment_ticks, ticks, side='right') - 1
+        new_ticks = self.segment_new_ticks[index] + (ticks - self.segment_ticks[index]) * self.segment_scales[index]
+        return np.round(new_ticks).astype(int)
 
     def remove(self, out_path):
         # write MIDI
@@ -71,21 +75,22 @@ class RemoveTempoSingle(object):
                 word = 'instrument_'
             inst = miditoolkit.midi.containers.Instrument(program, is_drum=is_drum,
                                                           name=word + str(program))
-            # rebuild notes
+            # rebuild notes (all start/end ticks mapped at once)
             rebuild_notes = []
-            for note in instrument.notes:
+            n_notes = len(instrument.notes)
+            new_ticks = self.map_ticks([note.start for note in instrument.notes] +
+                                       [note.end for note in instrument.notes]).tolist()
+            for note, st, et in zip(instrument.notes, new_ticks[:n_notes], new_ticks[n_notes:]):
                 pitch = note.pitch
                 velocity = note.velocity
-                st = self.accumulated_tick_time[note.start]
-                et = self.accumulated_tick_time[note.end]
                 rebuild_notes.append(miditoolkit.Note(velocity, pitch, st, et))
             inst.notes = rebuild_notes
             # rebuild controls
             rebuild_controls = []
-            for control in instrument.control_changes:
+            new_ticks = self.map_ticks([control.time for control in instrument.control_changes]).tolist()
+            for control, time in zip(instrument.control_changes, new_ticks):
                 number = control.number
                 value = control.value
-                time = self.accumulated_tick_time[control.time]
                 rebuild_controls.append(miditoolkit.ControlChange(number, value, time))
             inst.control_changes = rebuild_controls
             # push tracks